@@ -1,277 +1,313 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
-import requests
 import pandas as pd
-import ast
-import re
+from contextlib import contextmanager
 from datetime import datetime
-from io import BytesIO
+
+from engine import (
+    CACHE_PARSEO, CACHE_SQLITE, CacheParseo, FILAS_EXPORTACION_LIVIANA, FORMATOS_EXPORTACION, MAX_CONSULTAS_SIMULTANEAS,
+    FILTROS_TABLA, REGLAS_ALERTA, CacheConsultas, actualizar_conciliacion, aplicar_ediciones_pagina, consolidar_datos_tabla,
+    clave_idempotencia, construir_payload, consultar_api_tins, conteo_alertas, estilos_alerta,
+    exportar_reporte, extraer_tins, filas_filtradas, huella_contenido, huella_df, mascaras_alerta, parsear_trama, procesar_lote_bancario,
+    resumen_latencias, tins_a_reconsultar, tins_pagados, trama_desde_payload, validar_payload,
+)
+from jobs import ESTADOS_ACTIVOS, ESTADOS_REANUDABLES, JOBS_SQLITE, ColaTrabajos
+from logic_processor import REGLAS_POR_FLUJO
+from telemetry import RegistroTramos, activar_registro, tramos_jsonl, usar_registro
 
 st.set_page_config(page_title="Procesador KashIO", layout="wide")
 
-SERVICE_URL = "https://t5jezcpiwc.execute-api.us-east-1.amazonaws.com/LIVE"
-HEADERS = {'content-type': 'application/json'}
-AUTH_USER = ""
-AUTH_PSW = ""
-
-DICT_ACC = {
-    ('BCP',              'PEN'): 'acc_R8eMfP7Cdaq5ScUavLXBMX',
-    ('BCP',              'USD'): 'acc_ddcdxWdBFhtwhWMJQKZ46h',
-    ('BBVA',             'PEN'): 'acc_cZpQmjzkKdoEvmWfj4Qm9K',
-    ('BBVA',             'USD'): 'acc_S6tfrAUEnLcH2VNDiGt9d9',
-    ('IBK',              'PEN'): 'acc_rbzSXQuvc5FfMbR2z4vMGd',
-    ('IBK',              'USD'): 'acc_9FmSeoNUiQTL7bHd2JzJCb',
-    ('SCOTIA',           'PEN'): 'acc_R8eMfP7Cdaq5ScUavLXBMS',
-    ('SCOTIA',           'USD'): 'acc_cUtpw5swumqQRZDRZEcy23',
-    ('KASNET',           'PEN'): 'acc_5w9ujngtRTf8qgG7xYyMJm',
-    ('BILLETERA-NIUBIZ', 'PEN'): 'acc_KCKUEA8gNiAk9r73zz6NMh',
-    ('CARD',             'PEN'): 'acc_8v3EMCq7EuuK2Czp54KF6e',
-    ('BILLETERA-GMONEY', 'PEN'): 'acc_24205fe371034deb9731',
-}
-
-for key in ["df_conciliacion", "trama_generada", "alertas_pagados", "raw_api_results", "lineas_no_leidas"]:
-    if key not in st.session_state:
-        st.session_state[key] = pd.DataFrame() if key == "df_conciliacion" else ([] if key != "trama_generada" else "")
+@st.cache_resource
+def _cache_consultas():
+    return CacheConsultas(ruta_sqlite=CACHE_SQLITE)
 
 
-def consultar_api_tins(tin_list):
-    resultados = []
-    with requests.Session() as session:
-        session.auth = (AUTH_USER, AUTH_PSW)
-        session.headers.update({**HEADERS, 'User-Agent': 'PostmanRuntime/7.26.8'})
-        progreso = st.progress(0)
-        for idx, tin in enumerate(tin_list):
-            try:
-                r = session.get(f"{SERVICE_URL}/consultar/{tin}?search_by=PSP_TIN", timeout=15)
-                data = r.json() if r.status_code in (200, 201) else None
-                resultados.append({"tin": tin, "data": data, "error": None if data else r.status_code})
-            except Exception as e:
-                resultados.append({"tin": tin, "data": None, "error": str(e)})
-            progreso.progress((idx + 1) / len(tin_list))
-        progreso.empty()
-    return resultados
-
-
-def ejecutar_post_pagos(payload_list, usuario_operacion):
-    resultados = []
-    with requests.Session() as session:
-        session.auth = (AUTH_USER, AUTH_PSW)
-        session.headers.update(HEADERS)
-        progreso = st.progress(0)
-        for index, item in enumerate(payload_list):
-            tin = item.get('VOUCHER_PSP_TIN', 'N/A')
-            acc = DICT_ACC.get((item.get('VOUCHER_PSP'), item.get('VOUCHER_Currency')))
-            res_row = {'TIN': tin, 'STATUS': 'FALTA_CUENTA', 'MENSAJE': 'PSP/Moneda no configurado'}
-            if acc:
-                payload = {
-                    "invoice": {"id": tin},
-                    "payer": {"reference_number": tin},
-                    "amount": {"value": float(item.get('VOUCHER_Amount', 0)), "currency": item.get('VOUCHER_Currency')},
-                    "psp_account": {"id": acc},
-                    "operation_no": item.get('VOUCHER_Operacion_PSP'),
-                    "operation_date": item.get('VOUCHER_FECHA'),
-                    "branch_code": "",
-                    "channel_code": "WEB",
-                    "force_expire_payment": True,
-                    "metadata": {"code": usuario_operacion, "clave": "AR"}
-                }
-                try:
-                    resp = session.post(f"{SERVICE_URL}/pagomanual", timeout=30, json=payload)
-                    res_row['STATUS'] = resp.status_code
-                    res_row['MENSAJE'] = 'OK' if resp.status_code == 200 else resp.text
-                except Exception as e:
-                    res_row['STATUS'] = 'ERROR_RED'
-                    res_row['MENSAJE'] = str(e)
-            resultados.append(res_row)
-            progreso.progress((index + 1) / len(payload_list))
-        progreso.empty()
-    return pd.DataFrame(resultados)
-
-
-def _fecha_serial(yyyymmdd):
-    dt = datetime.strptime(yyyymmdd, "%Y%m%d")
-    return str((dt - datetime(1899, 12, 30)).days)
-
-
-def _parsear_bcp(line):
-    # TIN: 12 dígitos tras el último " 00000000". Bloque de 73 dígitos antes de "EFECTIVO":
-    # FECHA1[0:8] FECHA2[8:16] ... OPERACION[61:73] (los últimos 6 son el Nro OP).
-    tins = re.findall(r' 0{8}(\d{12})', line)
-    blk = re.search(r'(\d{73})EFECTIVO', line)
-    if not tins or not blk:
-        return None
-    b = blk.group(1)
-    return {
-        'tin': tins[-1],
-        'VOUCHER_Operacion_PSP': b[67:73],
-        'VOUCHER_FECHA': _fecha_serial(b[0:8]),
-    }
-
-
-def _parsear_ibk(line):
-    # TIN: 12 dígitos delimitados por espacios. Fecha: primera "2026xxxx".
-    # Operación/Referencia: 8 dígitos tras la última fecha "2026xxxx" de la línea.
-    mt = re.search(r'\s(\d{12})\s', line)
-    fechas = list(re.finditer(r'2026\d{4}', line))
-    if not mt or not fechas:
-        return None
-    ref = line[fechas[-1].end():fechas[-1].end() + 8]
-    if not re.fullmatch(r'\d{8}', ref):
-        return None
-    return {
-        'tin': mt.group(1),
-        'VOUCHER_Operacion_PSP': ref.lstrip('0'),
-        'VOUCHER_FECHA': _fecha_serial(fechas[0].group()),
-    }
-
-
-def _parsear_bbva(line):
-    # TIN: 12 dígitos antes del código de servicio. Fecha: última "2026xxxx" de la línea.
-    # Referencia: 6 dígitos que terminan 5 posiciones antes del inicio de la fecha.
-    # Se ancla en la cola (fecha) porque el código de servicio varía en prefijo (084x/085x)
-    # y en longitud, lo que desplaza los offsets absolutos.
-    mt = re.search(r'(\d{12})\s+\d{4}', line)
-    fechas = list(re.finditer(r'2026\d{4}', line))
-    if not mt or not fechas:
-        return None
-    fpos = fechas[-1].start()
-    ref = line[fpos - 11:fpos - 5]
-    if not re.fullmatch(r'\d{6}', ref):
-        return None
-    return {
-        'tin': mt.group(1),
-        'VOUCHER_Operacion_PSP': ref.lstrip('0'),
-        'VOUCHER_FECHA': _fecha_serial(fechas[-1].group()),
-    }
-
-
-def procesar_archivo_bancario(file_content):
-    lines = re.sub(r'[^\x20-\x7E\r\n]', ' ', file_content.decode("latin-1", errors="replace")).splitlines()
-    if not lines:
-        return {}, []
-
-    banco = "DESCONOCIDO"
-    first = lines[0]
-    if first.startswith("0120"):
-        banco = "BBVA"
-    elif first.startswith(("0791501", "0791502")):
-        banco = "IBK"
-    elif first.startswith("CC"):
-        banco = "BCP"
-
-    parsers = {"BCP": _parsear_bcp, "IBK": _parsear_ibk, "BBVA": _parsear_bbva}
-    detalle = {"BCP": "DD", "IBK": ("0791501", "0791502"), "BBVA": "02"}.get(banco)
-    parser = parsers.get(banco)
-
-    parsed_data = {}
-    no_leidas = []
-    if not parser:
-        return parsed_data, no_leidas
-
-    for line in lines:
-        if not line.startswith(detalle):
-            continue
-        try:
-            campos = parser(line)
-            if campos is None:
-                raise ValueError("estructura no reconocida")
-            tin = campos.pop('tin')
-            parsed_data[tin] = {'VOUCHER_PSP': banco, **campos}
-        except Exception:
-            no_leidas.append(line.rstrip())
-
-    return parsed_data, no_leidas
-
-
-def consolidar_datos_tabla(resultados_api, datos_txt):
-    filas = []
-    pagados = []
-    ahora = datetime.now()
-    fecha_rev = f"{ahora.month}/{ahora.day}/{ahora.year}"
-    mes_rev = ahora.strftime("%B")
-
-    COLUMN_ORDER = [
-        "Tipo", "Tipo2", "Empresa", "Fecha de revision", "Mes",
-        "PSP_TIN", "PSP_TIN concatenado", "Estado", "Public ID",
-        "inv_id concatenado", "PEN", "Monto voucher", "Monto Kashio",
-        "Balance", "CANAL", "Banco", "Nro OP", "VOUCHER_FECHA"
-    ]
-
-    for res in resultados_api:
-        t, d = res["tin"], res["data"]
-        info_txt = datos_txt.get(t, {})
-        base = {
-            "Tipo": "Reg.Interna", "Tipo2": "EECC",
-            "Fecha de revision": fecha_rev, "Mes": mes_rev,
-            "PSP_TIN": t, "PSP_TIN concatenado": f"'{t}',",
-            "CANAL": "WEB",
-            "Banco": info_txt.get('VOUCHER_PSP', 'COMPLETAR_BANCO'),
-            "Nro OP": info_txt.get('VOUCHER_Operacion_PSP', 'COMPLETAR_OPERACION'),
-            "VOUCHER_FECHA": info_txt.get('VOUCHER_FECHA', 'COMPLETAR_FECHA'),
-        }
-        if d:
-            act_list = d.get("activity_list", [])
-            estado = act_list[0].get("name", "N/A") if (isinstance(act_list, list) and act_list) else "N/A"
-            if d.get("status") == "PAID":
-                pagados.append(t)
-            monto_voucher = float(d.get("sub_total", {}).get("value", 0.0)) if d.get("sub_total") else 0.0
-            monto_kashio = float(d.get("total", {}).get("value", 0.0)) if d.get("total") else 0.0
-            filas.append({**base,
-                "Empresa": d.get("creditor", {}).get("name", "N/A"),
-                "Estado": estado,
-                "Public ID": d.get("public_id", "N/A"),
-                "inv_id concatenado": f"'{d.get('public_id', 'N/A')}',",
-                "PEN": d.get("sub_total", {}).get("currency", "N/A"),
-                "Monto voucher": monto_voucher, "Monto Kashio": monto_kashio,
-                "Balance": monto_kashio - monto_voucher,
-            })
-        else:
-            filas.append({**base,
-                "Empresa": "ERROR EN CONSULTA",
-                "Estado": f"Error HTTP {res.get('error')}",
-                "Public ID": "N/A", "inv_id concatenado": "N/A", "PEN": "N/A",
-                "Monto voucher": 0.0, "Monto Kashio": 0.0, "Balance": 0.0,
-            })
-
-    return pd.DataFrame(filas)[COLUMN_ORDER], pagados
-
-
-def extraer_trama_desde_df(df):
-    return "\n".join(
-        f"{{'VOUCHER_PSP':'{r['Banco']}','VOUCHER_PSP_TIN': '{r['PSP_TIN']}','VOUCHER_Currency': '{r['PEN']}','VOUCHER_Amount': {r['Monto voucher']},'VOUCHER_Operacion_PSP': '{r['Nro OP']}','VOUCHER_FECHA':'{r['VOUCHER_FECHA']}'}},"
-        for _, r in df.iterrows()
-    )
-
-
-def evaluar_trama_texto(texto):
-    clean = texto.strip()
-    if not clean:
-        return []
-    if not clean.startswith("["):
-        clean = f"[{clean}]"
-    return ast.literal_eval(clean)
-
-
-def aplicar_alertas_tabla(row):
-    estilos = [''] * len(row)
-    ALERTA = 'background-color: #ffe6e6; color: #cc0000; font-weight: bold;'
-    if 'Balance' in row.index:
-        try:
-            if abs(float(row['Balance'])) > 5:
-                estilos[row.index.get_loc('Balance')] = ALERTA
-        except: pass
-    for col in ['Monto voucher', 'Monto Kashio']:
-        if col in row.index:
-            try:
-                if float(row[col]) >= 500:
-                    estilos[row.index.get_loc(col)] = ALERTA
-            except: pass
-    return estilos
+@st.cache_resource
+def _cache_parseo():
+    return CacheParseo(ruta_sqlite=CACHE_PARSEO)
+
+
+@st.cache_resource
+def _cola_trabajos():
+    # Una sola cola por proceso: los trabajos de todos los operadores comparten hilos y límites por host.
+    return ColaTrabajos(ruta_sqlite=JOBS_SQLITE, cache_consultas=_cache_consultas())
+
+
+for key in ["df_conciliacion", "trama_generada", "alertas_pagados", "raw_api_results", "lineas_no_leidas", "conflictos_txt"]:
+    if key not in st.session_state:
+        st.session_state[key] = pd.DataFrame() if key == "df_conciliacion" else ([] if key != "trama_generada" else "")
+# raw_api_results: {tin: respuesta}; datos_txt: índice bancario de la última consulta completa.
+if not isinstance(st.session_state.raw_api_results, dict):
+    st.session_state.raw_api_results = {}
+st.session_state.setdefault("datos_txt", {})
+st.session_state.setdefault("version_editor", 0)
+st.session_state.setdefault("inicio_sesion", datetime.now().timestamp())
+# trabajos: ids encolados desde esta sesión; extractos_trabajo: datos bancarios de cada consulta encolada.
+st.session_state.setdefault("trabajos", [])
+st.session_state.setdefault("extractos_trabajo", {})
+st.session_state.setdefault("tiempos_importados", set())  # trabajos cuyos tramos ya están en telemetria
+if "telemetria" not in st.session_state:
+    st.session_state.telemetria = RegistroTramos()
+
+
+@st.cache_data(max_entries=6, show_spinner=False)
+def _reporte_cacheado(huella, formato, _df):
+    # Clave = hash de contenido de la tabla (con ediciones) + formato; _df no se hashea.
+    return exportar_reporte(_df, formato)
+
+
+def _reporte_descarga(df, formato, registro):
+    # Streamlit evalúa el callable fuera de esta ejecución del script: se reactiva el registro de la sesión.
+    with usar_registro(registro):
+        return _reporte_cacheado(huella_df(df), formato, df)
+
+
+def _panel_tiempos(registro):
+    resumen = registro.resumen()
+    if not resumen:
+        return
+    with st.expander("⏱️ Tiempos por etapa (sesión)", expanded=False):
+        st.dataframe(pd.DataFrame(resumen), width='stretch', hide_index=True)
+        col_exp, col_limpiar, _ = st.columns([2, 2, 6])
+        with col_exp:
+            st.download_button("Exportar JSONL", registro.a_jsonl(),
+                               f"tiempos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl", "application/x-ndjson")
+        with col_limpiar:
+            if st.button("Limpiar tiempos"):
+                registro.limpiar()
+                st.rerun()
+
+
+@contextmanager
+def _barra_progreso():
+    barra = st.progress(0)
+    try:
+        yield lambda hechos, total: barra.progress(hechos / total)
+    finally:
+        barra.empty()
+
+
+def _mascaras_alerta_cacheadas(df):
+    # Una sola evaluación por versión del DataFrame: filtro, estilos de la página y conteos
+    # comparten entrada mientras el operador no cambie los montos.
+    cache = st.session_state.setdefault("_mascaras_alerta", {})
+    clave = huella_df(df, [regla[0] for regla in REGLAS_ALERTA])
+    if clave not in cache:
+        if len(cache) >= 4:
+            cache.pop(next(iter(cache)))
+        cache[clave] = mascaras_alerta(df)
+    return cache[clave]
+
+
+def _parametros_pagos(payload, usuario):
+    # Regla única: no se envía ningún TIN cuyo estado actual sea PAID, venga de cache o de la consulta en vivo.
+    # El trabajo reconsulta antes de cada tanda los TIN servidos desde cache para que ese estado sea actual.
+    resultados = list(st.session_state.raw_api_results.values())
+    return {"payload": payload, "usuario": usuario, "pagados": tins_pagados(resultados),
+            "desde_cache": [r["tin"] for r in resultados if r.get("cache")]}
+
+
+TAMANOS_PAGINA = (100, 250, 500, 1000)
+
+
+def _pagina_editor(etiquetas, filtro, tamano, pagina):
+    # Cada vista (versión de la tabla, filtro, tamaño, página) tiene su propia clave de editor.
+    # Sus filas se fijan al abrirla: las posiciones del estado del editor no se mueven aunque
+    # una edición saque la fila del filtro.
+    clave = f"editor_conciliacion_{st.session_state.version_editor}_{filtro}_{tamano}_{pagina}"
+    actual = st.session_state.get("_pagina_editor")
+    if not actual or actual[0] != clave:
+        inicio = (pagina - 1) * tamano
+        actual = st.session_state._pagina_editor = (clave, etiquetas[inicio:inicio + tamano])
+    return actual
+
+
+def _guardar_ediciones(clave, etiquetas):
+    # on_change del editor: las ediciones de la página se aplican a la tabla base por etiqueta.
+    df, cambio_filas = aplicar_ediciones_pagina(st.session_state.df_conciliacion, etiquetas, st.session_state.get(clave))
+    st.session_state.df_conciliacion = df
+    if cambio_filas:
+        st.session_state.version_editor += 1  # filas borradas/agregadas: se reabre la vista
+
+
+def _reconsultar(tins_texto):
+    # Reconsulta fallidos, nuevos y marcados; parcha solo esas filas de la tabla base.
+    marcados = st.session_state.get("tins_marcados", [])
+    df_base = st.session_state.df_conciliacion
+    tins_tabla = [str(t) for t in df_base["PSP_TIN"].dropna()] if "PSP_TIN" in df_base else []
+    tins = tins_a_reconsultar(st.session_state.raw_api_results, tins_texto + tins_tabla, marcados)
+    if not tins:
+        st.info("No hay TIN con error, nuevos ni marcados para reconsultar.")
+        return
+    with st.spinner(f"Reconsultando {len(tins)} TIN..."):
+        with _barra_progreso() as progreso:
+            res_api = consultar_api_tins(tins, cache=_cache_consultas(), forzar=True, progreso=progreso)
+        df_final, pagados = actualizar_conciliacion(df_base, res_api, st.session_state.datos_txt)
+    st.session_state.raw_api_results.update((r["tin"], r) for r in res_api)
+    st.session_state.df_conciliacion = df_final
+    reconsultados = set(tins)
+    st.session_state.alertas_pagados = [t for t in st.session_state.alertas_pagados if t not in reconsultados] + pagados
+    st.session_state.tins_marcados = []
+    st.session_state.version_editor += 1
+    errores = sum(1 for r in res_api if not r["data"])
+    st.success(f"Reconsultados {len(tins)} TIN · {errores} siguen con error")
+
+
+def _avisar_extractos_repetidos(archivos):
+    # Al subir: extractos con el mismo contenido que uno procesado en una sesión anterior.
+    huellas = st.session_state.setdefault("_huellas_subidas", {})
+    for f in archivos:
+        if f.file_id not in huellas:
+            huellas[f.file_id] = huella_contenido(f.getvalue())
+        visto = _cache_parseo().visto(huellas[f.file_id])
+        if visto and visto[1] < st.session_state.inicio_sesion:
+            fecha = datetime.fromtimestamp(visto[1]).strftime("%d/%m/%Y %H:%M")
+            st.warning(f"«{f.name}» tiene el mismo contenido que «{visto[0]}», cargado el {fecha}.")
+
+
+def _procesar_extractos(archivos):
+    if not archivos:
+        return {}, [], []
+    datos_txt, lineas_no_leidas, conflictos_txt, resumen_txt = procesar_lote_bancario(
+        [(f.name, f.getvalue()) for f in archivos], cache=_cache_parseo())
+    for r in resumen_txt:
+        if r.get("repetido_de"):
+            st.warning(f"«{r['archivo']}» es idéntico a «{r['repetido_de']}» en esta carga; se ignoró.")
+    return datos_txt, lineas_no_leidas, conflictos_txt
+
+
+def _encolar(tipo, parametros):
+    job_id = _cola_trabajos().enviar(tipo, parametros, propietario=st.session_state.get("usuario_operador", "KNC"))
+    st.session_state.trabajos.append(job_id)
+    return job_id
+
+
+def _encolar_pagos(payload, usuario):
+    # Las operaciones que ya están en un trabajo de pagos activo (de cualquier operador) no se vuelven a encolar.
+    en_curso = {clave_idempotencia(p) for t in _cola_trabajos().activos("pagos") for p in t["parametros"]["payload"]}
+    nuevos = [p for p in payload if clave_idempotencia(p) not in en_curso]
+    if len(nuevos) < len(payload):
+        st.warning(f"Se omiten {len(payload) - len(nuevos)} operación(es) que ya están en un trabajo de pagos en curso.")
+    if not nuevos:
+        return 0
+    st.session_state.trabajo_pagos = _encolar("pagos", _parametros_pagos(nuevos, usuario))
+    return len(nuevos)
+
+
+def _pagos_en_curso():
+    # Mientras el último trabajo de pagos de la sesión siga activo, los botones de ejecución quedan deshabilitados.
+    job_id = st.session_state.get("trabajo_pagos")
+    estado = job_id and _cola_trabajos().estado(job_id)
+    return bool(estado) and estado["estado"] in ESTADOS_ACTIVOS
+
+
+def _cargar_consulta(job_id, archivos):
+    # Lleva a la tabla el resultado de un trabajo de consulta terminado.
+    cola = _cola_trabajos()
+    parciales = cola.parciales(job_id)
+    res_api = [parciales[t] for t in cola.estado(job_id)["parametros"]["tins"] if t in parciales]
+    extractos = st.session_state.extractos_trabajo.pop(job_id, None)
+    if extractos is None:
+        # Trabajo de otra sesión (o de antes de recargar la página): se usan los extractos subidos ahora.
+        extractos = _procesar_extractos(archivos)
+        if not archivos:
+            st.info("Resultado cargado sin extractos bancarios; súbalos y use «Reconsultar» si hacen falta.")
+    datos_txt, lineas_no_leidas, conflictos_txt = extractos
+    df_final, pagados = consolidar_datos_tabla(res_api, datos_txt)
+    hits = sum(1 for r in res_api if r.get("cache"))
+    st.session_state.cache_stats = (hits, len(res_api) - hits)
+    st.session_state.df_conciliacion = df_final
+    st.session_state.alertas_pagados = pagados
+    st.session_state.raw_api_results = {r["tin"]: r for r in res_api}
+    st.session_state.datos_txt = datos_txt
+    st.session_state.lineas_no_leidas = lineas_no_leidas
+    st.session_state.conflictos_txt = conflictos_txt
+    st.session_state.version_editor += 1
+
+
+ETIQUETAS_TRABAJO = {"consulta": "🔎 Consulta", "pagos": "💳 Pagos", "carga": "📤 Carga EDT"}
+
+
+def _resultado_trabajo(cola, trabajo):
+    parciales = cola.parciales(trabajo["id"])
+    if trabajo["tipo"] == "pagos":
+        return pd.DataFrame([parciales[k] for k in sorted(parciales, key=int)])
+    if trabajo["tipo"] == "carga":
+        archivos = trabajo["parametros"]["archivos"]
+        return pd.DataFrame([{"archivo": archivos[int(k)][0], "status": parciales[k]["status"], "details": parciales[k]["details"]}
+                             for k in sorted(parciales, key=int)])
+    return None
+
+
+@st.fragment(run_every=2)
+def _panel_trabajos():
+    # Se refresca solo (sin rerun de la página) mientras haya algo que mostrar.
+    cola = _cola_trabajos()
+    # Al terminar los pagos de la sesión se rehace la página para habilitar de nuevo los botones de ejecución.
+    if st.session_state.get("trabajo_pagos") and not _pagos_en_curso():
+        st.session_state.trabajo_pagos = None
+        st.rerun()
+    # La consulta más reciente de la sesión se carga sola al terminar.
+    ultima = st.session_state.get("trabajo_consulta")
+    estado = ultima and cola.estado(ultima)
+    if ultima and not estado:
+        st.session_state.trabajo_consulta = None  # ya no existe en la cola (p.ej. se borró jobs.sqlite3)
+    elif estado and estado["estado"] == "terminado":
+        st.session_state.trabajo_consulta = None
+        st.session_state.cargar_trabajo = ultima
+        st.rerun()
+    trabajos = [t for t in map(cola.estado, reversed(st.session_state.trabajos)) if t]
+    propios_sesion = set(st.session_state.trabajos)
+    if st.toggle("Ver trabajos de otros operadores", key="ver_trabajos_todos"):
+        trabajos += [t for t in cola.listar() if t["id"] not in propios_sesion]
+    if not trabajos:
+        return
+    st.markdown("##### Trabajos en segundo plano")
+    for t in trabajos:
+        col_info, col_barra, col_accion, col_extra = st.columns([3, 4, 1.5, 1.5])
+        with col_info:
+            hora = datetime.fromtimestamp(t["creado"]).strftime("%H:%M:%S")
+            st.markdown(f"**{ETIQUETAS_TRABAJO[t['tipo']]}** · {t['propietario']} · {hora}")
+        with col_barra:
+            texto = f"{t['estado']} · {t['hechos']}/{t['total']}" + (f" · {t['mensaje']}" if t["mensaje"] else "")
+            st.progress(t["hechos"] / t["total"] if t["total"] else 0.0, text=texto)
+        with col_accion:
+            if t["estado"] in ESTADOS_ACTIVOS:
+                st.button("Cancelar", key=f"cancelar_{t['id']}", disabled=t["estado"] == "cancelando",
+                          on_click=cola.cancelar, args=(t["id"],), width='stretch')
+            elif t["estado"] in ESTADOS_REANUDABLES:
+                st.button("Reanudar", key=f"reanudar_{t['id']}", on_click=cola.reanudar, args=(t["id"],), width='stretch')
+        with col_extra:
+            if t["tipo"] == "consulta" and t["estado"] == "terminado" and st.button("Cargar", key=f"cargar_{t['id']}", width='stretch'):
+                st.session_state.cargar_trabajo = t["id"]
+                st.rerun()
+        tramos = (t["resumen"] or {}).get("tramos", [])
+        if tramos and t["id"] in propios_sesion and t["id"] not in st.session_state.tiempos_importados:
+            # Los tiempos del trabajo corrieron en otro hilo: se suman una vez al registro de la sesión.
+            st.session_state.telemetria.extender(tramos)
+            st.session_state.tiempos_importados.add(t["id"])
+        if t["tipo"] != "consulta" and (t["estado"] not in ESTADOS_ACTIVOS or t["hechos"]):
+            with st.expander("Detalle", expanded=False):
+                st.dataframe(_resultado_trabajo(cola, t), width='stretch', hide_index=True)
+                if tramos:
+                    st.download_button("Exportar tiempos JSONL", tramos_jsonl(tramos),
+                                       f"tiempos_{t['tipo']}_{t['id']}.jsonl", "application/x-ndjson", key=f"tiempos_{t['id']}")
+                for _, mensaje in cola.eventos(t["id"])[-50:]:
+                    st.text(mensaje)
+
+
+def _mostrar_errores_trama(errores, etiqueta):
+    detalle = "\n".join(f"- {etiqueta} {nro}: {msg}" for nro, msg in errores[:50])
+    extra = f"\n- ... y {len(errores) - 50} más" if len(errores) > 50 else ""
+    st.error(f"Error de validación estructural en {len(errores)} registro(s); no se ejecutó ninguna operación.\n{detalle}{extra}")
 
 
 # ==========================================
 # UI
 # ==========================================
+# Los tramos de esta ejecución del script se acumulan en el registro de la sesión.
+activar_registro(st.session_state.telemetria)
+
 st.title("Procesamiento de Pagos KashIO")
 st.markdown("Plataforma operativa para validación y regularización de transacciones.")
 st.subheader("1. Consulta y Procesamiento Automático")
@@ -280,39 +316,44 @@ col_a, col_b = st.columns([1, 1])
 with col_a:
     input_tins = st.text_area("Códigos TIN", placeholder="Ingrese los códigos separados por salto de línea")
 with col_b:
-    archivo_txt = st.file_uploader("Archivo bancario (Opcional)", type=['txt'])
+    archivos_txt = st.file_uploader("Archivos bancarios (Opcional)", type=['txt'], accept_multiple_files=True)
+    _avisar_extractos_repetidos(archivos_txt or [])
 
-col_btn1, col_btn2, col_spacer = st.columns([1.5, 1.5, 7])
+col_btn1, col_btn2, col_btn3, col_opt, col_spacer = st.columns([1.5, 1.5, 1.5, 2, 3.5])
 with col_btn1:
     btn_consulta = st.button("Ejecutar Consulta", type="primary", width='stretch')
 with col_btn2:
     btn_json = st.button("Revisar Respuestas JSON", type="secondary", width='stretch')
+with col_btn3:
+    btn_reconsulta = st.button("Reconsultar Errores / Nuevos", type="secondary", width='stretch',
+                               disabled=st.session_state.df_conciliacion.empty)
+with col_opt:
+    forzar_consulta = st.checkbox("Forzar actualización (ignorar cache)")
 
 if btn_consulta:
-    candidatos = re.findall(r'\d+', input_tins)
-    tins_validos = [t[2:] if (t.startswith("00") and len(t) > 12) else t for t in candidatos if len(t) == 12 or (t.startswith("00") and len(t[2:]) == 12)]
-    if not tins_validos:
+    lista_unica = extraer_tins(input_tins)
+    if not lista_unica:
         st.warning("No se identificaron códigos TIN con la longitud requerida (12 dígitos).")
     else:
-        lista_unica = list(dict.fromkeys(tins_validos))
-        if archivo_txt:
-            datos_txt, lineas_no_leidas = procesar_archivo_bancario(archivo_txt.getvalue())
-        else:
-            datos_txt, lineas_no_leidas = {}, []
-        with st.spinner("Conectando al sistema central..."):
-            res_api = consultar_api_tins(lista_unica)
-            df_final, pagados = consolidar_datos_tabla(res_api, datos_txt)
-            st.session_state.df_conciliacion = df_final
-            st.session_state.alertas_pagados = pagados
-            st.session_state.raw_api_results = res_api
-            st.session_state.lineas_no_leidas = lineas_no_leidas
+        # Los extractos se leen aquí (rápido, con cache); las consultas al servicio van en segundo plano.
+        job_id = _encolar("consulta", {"tins": lista_unica, "forzar": forzar_consulta})
+        st.session_state.extractos_trabajo[job_id] = _procesar_extractos(archivos_txt)
+        st.session_state.trabajo_consulta = job_id
+
+if st.session_state.get("cargar_trabajo"):
+    _cargar_consulta(st.session_state.pop("cargar_trabajo"), archivos_txt)
+
+_panel_trabajos()
+
+if btn_reconsulta:
+    _reconsultar(extraer_tins(input_tins))
 
 if btn_json:
     if not st.session_state.raw_api_results:
         st.info("Debe ejecutar una consulta previa para cargar los registros en memoria.")
     else:
         st.markdown("### Respuestas Crudas del Servidor")
-        for registro in st.session_state.raw_api_results:
+        for registro in st.session_state.raw_api_results.values():
             with st.expander(f"Código TIN: {registro['tin']}", expanded=False):
                 if registro['data']:
                     st.json(registro['data'])
@@ -322,9 +363,20 @@ if btn_json:
 if not st.session_state.df_conciliacion.empty:
     st.divider()
     st.subheader("2. Tabla de Conciliación")
+    lat = resumen_latencias(list(st.session_state.raw_api_results.values()))
+    if lat:
+        st.caption(f"Latencia de consulta ({lat['n']} TIN, {MAX_CONSULTAS_SIMULTANEAS} simultáneas): p50 {lat['p50']} ms · p95 {lat['p95']} ms · máx {lat['max']} ms")
+    if st.session_state.get("cache_stats"):
+        hits, misses = st.session_state.cache_stats
+        st.caption(f"Cache de consultas: {hits} acierto(s) · {misses} consulta(s) al servicio")
     if st.session_state.alertas_pagados:
         st.warning(f"Se identificaron {len(st.session_state.alertas_pagados)} operaciones con estado previo de liquidación (PAID): {', '.join(st.session_state.alertas_pagados)}")
 
+    if st.session_state.conflictos_txt:
+        n = len(st.session_state.conflictos_txt)
+        with st.expander(f"⚠️ {n} TIN con Nro OP distinto entre archivos bancarios — se usó el del primer archivo", expanded=True):
+            st.dataframe(pd.DataFrame(st.session_state.conflictos_txt), width='stretch')
+
     if st.session_state.lineas_no_leidas:
         n = len(st.session_state.lineas_no_leidas)
         with st.expander(f"⚠️ {n} línea(s) del archivo bancario no pudieron leerse — revisar manualmente", expanded=True):
@@ -332,56 +384,96 @@ if not st.session_state.df_conciliacion.empty:
             for ln in st.session_state.lineas_no_leidas:
                 st.code(ln, language=None)
 
-    df_estilizado = st.session_state.df_conciliacion.style.apply(aplicar_alertas_tabla, axis=1)
-    df_editado = st.data_editor(df_estilizado, num_rows="dynamic", width='stretch')
-
-    montos = pd.to_numeric(df_editado.get("Monto voucher"), errors="coerce")
-    montos_k = pd.to_numeric(df_editado.get("Monto Kashio"), errors="coerce")
-    balances = pd.to_numeric(df_editado.get("Balance"), errors="coerce")
-    n_monto = int(((montos > 500) | (montos_k > 500)).sum())
-    n_balance = int((balances.abs() > 5).sum())
-    if n_monto or n_balance:
-        avisos = []
-        if n_monto:
-            avisos.append(f"{n_monto} operación(es) con Monto voucher o Monto Kashio mayor a 500")
-        if n_balance:
-            avisos.append(f"{n_balance} operación(es) con Balance mayor a 5")
+    # Filtro y paginación en el servidor: al navegador solo va la página visible. La tabla base ya
+    # incluye las ediciones, así que alertas, trama y reporte la usan directamente.
+    df_base = st.session_state.df_conciliacion
+    mascaras_base = _mascaras_alerta_cacheadas(df_base)
+    col_filtro, col_tamano, col_pagina = st.columns([5, 1.5, 1.5])
+    with col_filtro:
+        filtro = st.radio("Mostrar", FILTROS_TABLA, horizontal=True, key="filtro_tabla")
+    con_error = [t for t, r in st.session_state.raw_api_results.items() if not r["data"]]
+    etiquetas = filas_filtradas(df_base, filtro, mascaras_base, st.session_state.alertas_pagados, con_error)
+    with col_tamano:
+        tamano = st.selectbox("Filas por página", TAMANOS_PAGINA, index=2, key="tamano_pagina")
+    paginas = max(1, -(-len(etiquetas) // tamano))
+    if st.session_state.get("pagina_tabla", 1) > paginas:
+        st.session_state.pagina_tabla = 1
+    with col_pagina:
+        pagina = st.number_input("Página", min_value=1, max_value=paginas, step=1, key="pagina_tabla", disabled=paginas == 1)
+    clave, visibles = _pagina_editor(etiquetas, filtro, tamano, pagina)
+    st.caption(f"{len(etiquetas)} de {len(df_base)} fila(s) · página {pagina} de {paginas}")
+    df_pagina = df_base.loc[visibles]
+    df_estilizado = df_pagina.style.apply(estilos_alerta, axis=None, mascaras={c: m.loc[visibles] for c, m in mascaras_base.items()})
+    st.data_editor(df_estilizado, num_rows="dynamic", width='stretch', key=clave, on_change=_guardar_ediciones, args=(clave, visibles))
+    st.multiselect("TIN marcados para reconsultar", df_base["PSP_TIN"].dropna().astype(str).unique(), key="tins_marcados",
+                   help="Se reconsultan con «Reconsultar Errores / Nuevos» junto con los TIN con error y los agregados.")
+
+    avisos = [f"{n} operación(es) con {texto}" for texto, n in conteo_alertas(df_base, mascaras_base).items() if n]
+    if avisos:
         st.error("⚠️ " + " · ".join(avisos) + ". Revisar antes de ejecutar.")
 
-    trama_texto_vivo = extraer_trama_desde_df(df_editado)
-    st.session_state.trama_generada = trama_texto_vivo
+    payload_vivo = construir_payload(df_base)
 
-    excel_buffer = BytesIO()
-    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-        df_editado.to_excel(writer, index=False, sheet_name='Conciliacion')
-    st.download_button("Descargar Reporte (Excel)", excel_buffer.getvalue(), f"Reporte_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    # El reporte se genera solo al pulsar descargar (callable diferido) y se cachea por contenido.
+    col_fmt, col_descarga = st.columns([2, 3])
+    with col_fmt:
+        formatos = list(FORMATOS_EXPORTACION)
+        formato = st.radio("Formato del reporte", formatos, horizontal=True,
+                           index=formatos.index("csv") if len(df_base) >= FILAS_EXPORTACION_LIVIANA else 0)
+    extension, mime = FORMATOS_EXPORTACION[formato]
+    with col_descarga:
+        st.download_button(f"Descargar Reporte ({extension.upper()})",
+                           lambda df=df_base, fmt=formato, reg=st.session_state.telemetria: _reporte_descarga(df, fmt, reg),
+                           f"Reporte_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}", mime)
 
     st.divider()
     st.subheader("3. Panel de Ejecución")
-    usuario_operador = st.text_input("Iniciales del Usuario Operativo", value="KNC")
-
-    if st.button("Ejecutar Operaciones Automáticamente", type="primary"):
-        payload_auto = evaluar_trama_texto(trama_texto_vivo)
-        if not payload_auto:
+    usuario_operador = st.text_input("Iniciales del Usuario Operativo", value="KNC", key="usuario_operador")
+
+    pagos_en_curso = _pagos_en_curso()
+    if pagos_en_curso:
+        st.info("Hay un trabajo de pagos en curso; la ejecución se habilita cuando termine.")
+    if st.button("Ejecutar Operaciones Automáticamente", type="primary", disabled=pagos_en_curso):
+        payload_auto, errores = validar_payload(payload_vivo)
+        if errores:
+            _mostrar_errores_trama(errores, "Fila")
+        elif not payload_auto:
             st.error("La tabla de operaciones se encuentra vacía.")
         else:
-            with st.spinner("Procesando operaciones automáticas..."):
-                df_resultados = ejecutar_post_pagos(payload_auto, usuario_operador)
-                st.dataframe(df_resultados, width='stretch')
-                st.success("Flujo automático completado.")
+            encoladas = _encolar_pagos(payload_auto, usuario_operador)
+            if encoladas:
+                st.success(f"{encoladas} operación(es) automáticas encoladas; el avance se ve en «Trabajos en segundo plano».")
 
     st.markdown("---")
     st.markdown("Estructura de Datos Manual (Trama)")
-    trama_ingreso = st.text_area("Caja de edición técnica", value=st.session_state.trama_generada, height=180)
-
-    if st.button("Ejecutar Trama Manual"):
-        try:
-            payload_manual = evaluar_trama_texto(trama_ingreso)
-            if not payload_manual:
-                raise ValueError("Estructura vacía.")
-            with st.spinner("Procesando operaciones manuales..."):
-                df_resultados = ejecutar_post_pagos(payload_manual, usuario_operador)
-                st.dataframe(df_resultados, width='stretch')
-                st.success("Flujo manual completado.")
-        except Exception as e:
-            st.error(f"Error de validación estructural: {e}")
+    # El texto de la trama solo se arma cuando el operador abre la edición manual.
+    if st.toggle("Editar trama manual (JSON / NDJSON)"):
+        st.session_state.trama_generada = trama_desde_payload(payload_vivo)
+        trama_ingreso = st.text_area("Caja de edición técnica", value=st.session_state.trama_generada, height=180)
+
+        if st.button("Ejecutar Trama Manual", disabled=pagos_en_curso):
+            payload_manual, errores = parsear_trama(trama_ingreso)
+            if errores:
+                _mostrar_errores_trama(errores, "Línea")
+            elif not payload_manual:
+                st.error("Error de validación estructural: Estructura vacía.")
+            else:
+                encoladas = _encolar_pagos(payload_manual, usuario_operador)
+                if encoladas:
+                    st.success(f"{encoladas} operación(es) manuales encoladas; el avance se ve en «Trabajos en segundo plano».")
+
+st.divider()
+st.subheader("Carga de Archivos EDT")
+col_edt, col_flujo = st.columns([3, 1])
+with col_edt:
+    archivos_edt = st.file_uploader("Archivos EDT", type=['txt'], accept_multiple_files=True, key="archivos_edt")
+with col_flujo:
+    flujo_edt = st.selectbox("Flujo", list(REGLAS_POR_FLUJO), format_func=str.upper)
+if st.button("Encolar Carga", disabled=not archivos_edt):
+    # Copias en el directorio de la cola: la carga sigue y se puede reanudar aunque se recargue la página.
+    cola = _cola_trabajos()
+    archivos = [[f.name, cola.archivar(f.name, f.getvalue()), flujo_edt] for f in archivos_edt]
+    _encolar("carga", {"archivos": archivos})
+    st.success(f"{len(archivos)} archivo(s) encolados; el avance se ve en «Trabajos en segundo plano».")
+
+_panel_tiempos(st.session_state.telemetria)
@@ -0,0 +1,591 @@
+# -*- coding: utf-8 -*-
+"""Lectura de archivos bancarios (BCP, IBK, BBVA) para la conciliación de pagos.
+
+Los patrones se compilan una sola vez y están anclados para que cada línea se
+recorra una vez; donde el formato es fijo se usan cortes por posición. El
+archivo se lee línea a línea (bytes, objeto archivo o mmap de una ruta), así que
+la memoria no crece con el tamaño del extracto.
+"""
+import hashlib
+import json
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from datetime import date
+from functools import lru_cache
+from collections import OrderedDict
+from collections.abc import Mapping
+from itertools import chain
+
+from telemetry import RegistroTramos, registro_actual, tramo, usar_registro
+
+# Subir al cambiar cualquier parser: invalida los resultados guardados en CacheParseo.
+VERSION_PARSER = 5
+
+# Fecha AAAAMMDD de cualquier año 20xx (antes era el literal "2026").
+FECHA = r'20\d{2}(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])'
+
+_RE_FECHA = re.compile(FECHA)
+# Última fecha en la misma secuencia sin solapamiento que recorrería finditer.
+_RE_FECHA_ULTIMA = re.compile(r'(?:.*?(' + FECHA + '))+')
+_RE_BCP_TIN = re.compile(r'.* 0{8}(\d{12})')                 # greedy: último " 00000000" + TIN
+_RE_BCP_BLOQUE = re.compile(r'(\d{73})EFECTIVO')
+_RE_IBK_TIN = re.compile(r'\s(\d{12})\s')
+_RE_BBVA_TIN = re.compile(r'(\d{12})\s+\d{4}')
+
+# Bytes fuera de \x20-\x7E (salvo \r \n) se reemplazan por espacio, como hacía el re.sub original.
+_TABLA_LIMPIEZA = bytes(b if (0x20 <= b <= 0x7E or b in (0x0A, 0x0D)) else 0x20 for b in range(256))
+
+_ORDINAL_BASE_SERIAL = date(1899, 12, 30).toordinal()
+
+
+@lru_cache(maxsize=4096)
+def _fecha_serial(yyyymmdd):
+    d = date(int(yyyymmdd[0:4]), int(yyyymmdd[4:6]), int(yyyymmdd[6:8]))
+    return str(d.toordinal() - _ORDINAL_BASE_SERIAL)
+
+
+def _parsear_bcp(line):
+    # TIN: 12 dígitos tras el último " 00000000". Bloque de 73 dígitos antes de "EFECTIVO":
+    # FECHA1[0:8] FECHA2[8:16] ... OPERACION[61:73] (los últimos 6 son el Nro OP).
+    mt = _RE_BCP_TIN.match(line)
+    blk = _RE_BCP_BLOQUE.search(line)
+    if not mt or not blk:
+        return None
+    b = blk.group(1)
+    return {
+        'tin': mt.group(1),
+        'VOUCHER_Operacion_PSP': b[67:73],
+        'VOUCHER_FECHA': _fecha_serial(b[0:8]),
+    }
+
+
+def _parsear_ibk(line):
+    # TIN: 12 dígitos delimitados por espacios. Fecha: primera fecha AAAAMMDD después del TIN.
+    # Operación/Referencia: 8 dígitos tras la última fecha de la línea.
+    # Las fechas se buscan desde el fin del TIN: un TIN como 120250115999 contiene "20250115".
+    mt = _RE_IBK_TIN.search(line)
+    if not mt:
+        return None
+    primera = _RE_FECHA.search(line, mt.end())
+    if not primera:
+        return None
+    fin = _RE_FECHA_ULTIMA.match(line, mt.end()).end(1)
+    ref = line[fin:fin + 8]
+    if len(ref) != 8 or not ref.isdigit():
+        return None
+    return {
+        'tin': mt.group(1),
+        'VOUCHER_Operacion_PSP': ref.lstrip('0'),
+        'VOUCHER_FECHA': _fecha_serial(primera.group()),
+    }
+
+
+def _parsear_bbva(line):
+    # TIN: 12 dígitos antes del código de servicio. Tras el código van la referencia (6 dígitos),
+    # 5 ceros y la fecha AAAAMMDD: la fecha es la primera que empieza al menos 11 posiciones
+    # después de los 4 primeros dígitos del código, que varía en prefijo (084x/085x) y en longitud.
+    # No se toma la última fecha de la línea: el importe del final puede contener una (0020250301).
+    mt = _RE_BBVA_TIN.search(line)
+    if not mt:
+        return None
+    mf = _RE_FECHA.search(line, mt.end() + 11)
+    if not mf:
+        return None
+    fpos = mf.start()
+    ref = line[fpos - 11:fpos - 5]
+    if len(ref) != 6 or not ref.isdigit():
+        return None
+    return {
+        'tin': mt.group(1),
+        'VOUCHER_Operacion_PSP': ref.lstrip('0'),
+        'VOUCHER_FECHA': _fecha_serial(mf.group()),
+    }
+
+
+# banco -> (prefijo de la línea de detalle, parser)
+PARSERS = {
+    "BCP": ("DD", _parsear_bcp),
+    "IBK": (("0791501", "0791502"), _parsear_ibk),
+    "BBVA": ("02", _parsear_bbva),
+}
+
+
+# Código compacto de banco (uint8) y ancho con ceros del Nro OP por banco.
+BANCOS = tuple(PARSERS)
+ANCHO_OPERACION = {"BCP": 6}
+
+
+def _rellenar_ceros(textos, ancho):
+    import numpy as np
+
+    return np.char.zfill(textos, ancho) if len(textos) else textos  # zfill falla con arreglos vacíos
+
+
+def _textos_operacion(bancos, op):
+    # Nro OP como texto (objeto), con el ancho de cada banco; "" si no hay número (-1).
+    op_txt = op.astype(str)
+    for codigo, banco in enumerate(BANCOS):
+        if banco in ANCHO_OPERACION:
+            m = bancos == codigo
+            op_txt[m] = _rellenar_ceros(op_txt[m], ANCHO_OPERACION[banco])
+    op_txt = op_txt.astype(object)
+    op_txt[op < 0] = ""
+    return op_txt
+
+
+class IndiceTins(Mapping):
+    """Registros bancarios por TIN en columnas numpy, ordenadas por TIN.
+
+    Por registro: TIN int64, banco uint8 (índice en BANCOS), Nro OP int64 (-1 si vacío)
+    y fecha serial int32, ~21 bytes frente a un dict con tres str. Se usa como un dict
+    de solo lectura ``{tin: {VOUCHER_PSP, VOUCHER_Operacion_PSP, VOUCHER_FECHA}}`` y
+    ``to_frame`` arma el DataFrame del join directo desde las columnas.
+    """
+    __slots__ = ("_tin", "_banco", "_op", "_fecha")
+
+    def __init__(self, tin=(), banco=(), op=(), fecha=()):
+        # Columnas en orden de lectura; si un TIN se repite gana la última aparición.
+        import numpy as np
+
+        tin = np.asarray(tin, dtype=np.int64)
+        _, ultima = np.unique(tin[::-1], return_index=True)
+        pos = len(tin) - 1 - ultima
+        self._tin = tin[pos]
+        self._banco = np.asarray(banco, dtype=np.uint8)[pos]
+        self._op = np.asarray(op, dtype=np.int64)[pos]
+        self._fecha = np.asarray(fecha, dtype=np.int32)[pos]
+
+    def _posicion(self, tin):
+        import numpy as np
+
+        if not (isinstance(tin, str) and len(tin) == 12 and tin.isdigit()):
+            return None
+        i = int(np.searchsorted(self._tin, int(tin)))
+        return i if i < len(self._tin) and self._tin[i] == int(tin) else None
+
+    def _registro(self, i):
+        banco = BANCOS[self._banco[i]]
+        op = int(self._op[i])
+        return {
+            'VOUCHER_PSP': banco,
+            'VOUCHER_Operacion_PSP': "" if op < 0 else str(op).zfill(ANCHO_OPERACION.get(banco, 0)),
+            'VOUCHER_FECHA': str(int(self._fecha[i])),
+        }
+
+    def __getitem__(self, tin):
+        i = self._posicion(tin)
+        if i is None:
+            raise KeyError(tin)
+        return self._registro(i)
+
+    def __contains__(self, tin):
+        return self._posicion(tin) is not None
+
+    def __len__(self):
+        return len(self._tin)
+
+    def __iter__(self):
+        return (f"{t:012d}" for t in self._tin.tolist())
+
+    def nbytes(self):
+        return self._tin.nbytes + self._banco.nbytes + self._op.nbytes + self._fecha.nbytes
+
+    def to_frame(self, tins=None):
+        """DataFrame indexado por TIN (str) con VOUCHER_PSP, VOUCHER_Operacion_PSP y VOUCHER_FECHA.
+
+        Con ``tins`` solo las filas de esos TIN presentes en el índice (sin repetir).
+        """
+        import numpy as np
+        import pandas as pd
+
+        if tins is None:
+            pos = np.arange(len(self._tin))
+        else:
+            pedidos = np.unique(np.array([int(t) for t in tins if isinstance(t, str) and len(t) == 12 and t.isdigit()],
+                                         dtype=np.int64))
+            pos = np.searchsorted(self._tin, pedidos)
+            if len(self._tin):
+                pos = pos[self._tin[np.minimum(pos, len(self._tin) - 1)] == pedidos]
+            else:
+                pos = pos[:0]
+        bancos = self._banco[pos]
+        return pd.DataFrame(
+            {
+                'VOUCHER_PSP': np.array(BANCOS, dtype=object)[bancos],
+                'VOUCHER_Operacion_PSP': _textos_operacion(bancos, self._op[pos]),
+                'VOUCHER_FECHA': self._fecha[pos].astype(str).astype(object),
+            },
+            index=pd.Index(_rellenar_ceros(self._tin[pos].astype(str), 12).astype(object), dtype=object),
+        )
+
+    def a_bytes(self):
+        return b"".join([struct.pack("<q", len(self._tin)), self._tin.tobytes(), self._banco.tobytes(),
+                         self._op.tobytes(), self._fecha.tobytes()])
+
+    @classmethod
+    def desde_bytes(cls, datos):
+        import numpy as np
+
+        (n,) = struct.unpack_from("<q", datos)
+        indice = cls.__new__(cls)
+        desde = 8
+        for campo, dtype in (("_tin", np.int64), ("_banco", np.uint8), ("_op", np.int64), ("_fecha", np.int32)):
+            columna = np.frombuffer(datos, dtype=dtype, count=n, offset=desde)
+            setattr(indice, campo, columna)
+            desde += columna.nbytes
+        return indice
+
+    @classmethod
+    def combinar(cls, indices):
+        """Une varios índices; si un TIN está en más de uno gana el primero.
+
+        Devuelve ``(indice, repetidos)`` con ``repetidos`` = [(tin, i_primero, i_otro)]
+        para los TIN cuyo Nro OP difiere del que quedó.
+        """
+        import numpy as np
+
+        if len(indices) == 1:
+            return indices[0], []
+        origen = np.concatenate([np.full(len(ind), i, dtype=np.int32) for i, ind in enumerate(indices)])
+        tin = np.concatenate([ind._tin for ind in indices])
+        orden = np.argsort(tin, kind="stable")
+        tin_ord, origen_ord = tin[orden], origen[orden]
+        primero = np.ones(len(tin_ord), dtype=bool)
+        primero[1:] = tin_ord[1:] != tin_ord[:-1]
+        ordenados = {campo: np.concatenate([getattr(ind, campo) for ind in indices])[orden] for campo in cls.__slots__}
+        combinado = cls.__new__(cls)
+        for campo, columna in ordenados.items():
+            setattr(combinado, campo, columna[primero])
+        # Cada fila repetida contra la que quedó de su TIN, en bloque: primero banco y número,
+        # y solo donde difieren el texto del Nro OP (el ancho depende del banco).
+        rep = np.flatnonzero(~primero)
+        ganadora = np.flatnonzero(primero)[np.cumsum(primero)[rep] - 1]
+        banco, op = ordenados["_banco"], ordenados["_op"]
+        distinto = (banco[rep] != banco[ganadora]) | (op[rep] != op[ganadora])
+        distinto, ganadora = rep[distinto], ganadora[distinto]
+        conflicto = _textos_operacion(banco[distinto], op[distinto]) != _textos_operacion(banco[ganadora], op[ganadora])
+        distinto, ganadora = distinto[conflicto], ganadora[conflicto]
+        repetidos = list(zip(_rellenar_ceros(tin_ord[distinto].astype(str), 12).tolist(),
+                             origen_ord[ganadora].tolist(), origen_ord[distinto].tolist()))
+        return combinado, repetidos
+
+
+def detectar_banco(first):
+    if first.startswith("0120"):
+        return "BBVA"
+    if first.startswith(("0791501", "0791502")):
+        return "IBK"
+    if first.startswith("CC"):
+        return "BCP"
+    return "DESCONOCIDO"
+
+
+def limpiar(file_content):
+    return file_content.translate(_TABLA_LIMPIEZA).decode("ascii")
+
+
+@contextmanager
+def _abrir_fuente(fuente):
+    # bytes -> BytesIO (sin copia), ruta -> mmap de solo lectura, objeto archivo -> tal cual.
+    if isinstance(fuente, (bytes, bytearray, memoryview)):
+        yield BytesIO(fuente)
+    elif isinstance(fuente, (str, os.PathLike)):
+        with open(fuente, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield f
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    yield mm
+    else:
+        yield fuente
+
+
+def _lineas_crudas(archivo):
+    # Mismos cortes que str.splitlines() sobre el texto limpio: \r\n, \n o \r sueltos.
+    for linea in iter(archivo.readline, b""):
+        if linea.endswith(b"\n"):
+            linea = linea[:-1]
+        if linea.endswith(b"\r"):
+            linea = linea[:-1]
+        if b"\r" in linea:
+            yield from linea.split(b"\r")
+        else:
+            yield linea
+
+
+def iterar_archivo_bancario(fuente):
+    """Genera los registros de un archivo bancario sin cargarlo completo en memoria.
+
+    ``fuente`` puede ser bytes, una ruta (se lee con mmap) o un objeto archivo
+    binario. El banco se detecta con el primer registro. Produce ``(tin, campos)``
+    por cada línea de detalle leída y ``(None, linea)`` por cada línea de detalle
+    que no coincide con la estructura esperada.
+    """
+    with _abrir_fuente(fuente) as archivo:
+        lineas = _lineas_crudas(archivo)
+        first = next(lineas, None)
+        if first is None:
+            return
+        banco = detectar_banco(limpiar(first))
+        if banco not in PARSERS:
+            return
+        detalle, parser = PARSERS[banco]
+        detalle_b = tuple(d.encode("ascii") for d in detalle) if isinstance(detalle, tuple) else detalle.encode("ascii")
+        for cruda in chain((first,), lineas):
+            if not cruda.startswith(detalle_b):
+                continue
+            line = limpiar(cruda)
+            try:
+                campos = parser(line)
+                if campos is None:
+                    raise ValueError("estructura no reconocida")
+                tin = campos.pop('tin')
+                yield tin, {'VOUCHER_PSP': banco, **campos}
+            except Exception:
+                yield None, line.rstrip()
+
+
+def procesar_archivo_bancario(file_content):
+    # Índice por TIN (IndiceTins, gana la última línea) y líneas no leídas.
+    tins, bancos, ops, fechas = array('q'), array('B'), array('q'), array('i')
+    codigos = {banco: i for i, banco in enumerate(BANCOS)}
+    no_leidas = []
+    with tramo("procesar_archivo_bancario") as t:
+        for tin, campos in iterar_archivo_bancario(file_content):
+            if tin is None:
+                no_leidas.append(campos)
+                continue
+            op = campos['VOUCHER_Operacion_PSP']
+            tins.append(int(tin))
+            bancos.append(codigos[campos['VOUCHER_PSP']])
+            ops.append(int(op) if op else -1)
+            fechas.append(int(campos['VOUCHER_FECHA']))
+        parsed_data = IndiceTins(tins, bancos, ops, fechas)
+        t.update(bytes=_tamano_fuente(file_content), registros=len(parsed_data), no_leidas=len(no_leidas))
+    return parsed_data, no_leidas
+
+
+def _tamano_fuente(fuente):
+    if isinstance(fuente, (bytes, bytearray, memoryview)):
+        return len(fuente)
+    if isinstance(fuente, (str, os.PathLike)):
+        return os.path.getsize(fuente)
+    return 0
+
+
+def _nucleos_disponibles():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# ==========================================
+# Cache de resultados por contenido
+# ==========================================
+CACHE_PARSEO_MAX_ENTRADAS = 64      # en disco
+CACHE_PARSEO_MAX_MEMORIA = 8        # en memoria (los índices pueden ser grandes)
+CACHE_PARSEO_MAX_VISTOS = 5000
+CACHE_PARSEO = os.environ.get("KASHIO_CACHE_PARSEO", "cache_parseo.sqlite3")
+
+
+def huella_contenido(fuente):
+    """blake2b del contenido (bytes o ruta); None para objetos archivo, que no se cachean."""
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(fuente, (bytes, bytearray, memoryview)):
+        h.update(fuente)
+    elif isinstance(fuente, (str, os.PathLike)):
+        with open(fuente, "rb") as f:
+            for bloque in iter(lambda: f.read(1 << 20), b""):
+                h.update(bloque)
+    else:
+        return None
+    return h.hexdigest()
+
+
+def _entrada_a_blob(entrada):
+    # zlib( JSON [banco, no_leidas] + \0 + columnas del IndiceTins ).
+    banco, datos, no_leidas = entrada
+    cabecera = json.dumps([banco, no_leidas], separators=(",", ":")).encode()
+    return zlib.compress(cabecera + b"\0" + datos.a_bytes(), 6)
+
+
+def _entrada_desde_blob(blob):
+    cabecera, _, columnas = zlib.decompress(blob).partition(b"\0")
+    banco, no_leidas = json.loads(cabecera)
+    return banco, IndiceTins.desde_bytes(columnas), no_leidas
+
+
+class CacheParseo:
+    """Resultados de procesar_archivo_bancario por huella de contenido + VERSION_PARSER.
+
+    LRU acotada en memoria y, con ``ruta_sqlite``, en disco (columnas comprimidas con zlib),
+    compartida entre sesiones. También recuerda cuándo y con qué nombre se vio cada
+    contenido por primera vez, para avisar de extractos ya cargados.
+    """
+
+    def __init__(self, ruta_sqlite=None, max_entradas=CACHE_PARSEO_MAX_ENTRADAS, max_memoria=CACHE_PARSEO_MAX_MEMORIA):
+        self.ruta_sqlite = ruta_sqlite
+        self.max_entradas = max_entradas
+        self.max_memoria = max_memoria
+        self.hits = 0
+        self.misses = 0
+        self._datos = OrderedDict()
+        self._vistos = {}
+        self._lock = threading.Lock()
+        if ruta_sqlite:
+            with self._sqlite() as con:
+                con.execute("CREATE TABLE IF NOT EXISTS parseos (clave TEXT PRIMARY KEY, usado REAL, datos BLOB)")
+                con.execute("CREATE TABLE IF NOT EXISTS vistos (huella TEXT PRIMARY KEY, archivo TEXT, fecha REAL)")
+
+    def _sqlite(self):
+        return sqlite3.connect(self.ruta_sqlite, timeout=30)
+
+    def obtener(self, huella):
+        clave = f"{VERSION_PARSER}:{huella}"
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None and self.ruta_sqlite:
+                with self._sqlite() as con:
+                    fila = con.execute("SELECT datos FROM parseos WHERE clave = ?", (clave,)).fetchone()
+                    if fila:
+                        con.execute("UPDATE parseos SET usado = ? WHERE clave = ?", (time.time(), clave))
+                if fila:
+                    entrada = _entrada_desde_blob(fila[0])
+                    self._recordar(clave, entrada)
+            if entrada is None:
+                self.misses += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return entrada
+
+    def _recordar(self, clave, entrada):
+        self._datos[clave] = entrada
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.max_memoria:
+            self._datos.popitem(last=False)
+
+    def guardar(self, huella, banco, datos, no_leidas):
+        clave = f"{VERSION_PARSER}:{huella}"
+        entrada = (banco, datos, no_leidas)
+        with self._lock:
+            self._recordar(clave, entrada)
+            if self.ruta_sqlite:
+                blob = _entrada_a_blob(entrada)
+                with self._sqlite() as con:
+                    con.execute("INSERT OR REPLACE INTO parseos VALUES (?, ?, ?)", (clave, time.time(), blob))
+                    con.execute("DELETE FROM parseos WHERE clave NOT IN "
+                                "(SELECT clave FROM parseos ORDER BY usado DESC LIMIT ?)", (self.max_entradas,))
+
+    def visto(self, huella):
+        """(archivo, fecha epoch) de la primera vez que se procesó este contenido, o None."""
+        with self._lock:
+            if huella in self._vistos:
+                return self._vistos[huella]
+            if not self.ruta_sqlite:
+                return None
+            with self._sqlite() as con:
+                fila = con.execute("SELECT archivo, fecha FROM vistos WHERE huella = ?", (huella,)).fetchone()
+            return tuple(fila) if fila else None
+
+    def registrar_visto(self, huella, archivo):
+        # Solo la primera vez: la fecha es la de la carga original.
+        if self.visto(huella) is not None:
+            return
+        with self._lock:
+            self._vistos[huella] = (archivo, time.time())
+            if self.ruta_sqlite:
+                with self._sqlite() as con:
+                    con.execute("INSERT OR IGNORE INTO vistos VALUES (?, ?, ?)", (huella, archivo, time.time()))
+                    con.execute("DELETE FROM vistos WHERE huella NOT IN "
+                                "(SELECT huella FROM vistos ORDER BY fecha DESC LIMIT ?)", (CACHE_PARSEO_MAX_VISTOS,))
+
+
+def _procesar_archivo_nombrado(nombre, fuente):
+    # Se ejecuta en un proceso del pool: debe ser una función de módulo (picklable).
+    # Los tramos se devuelven al proceso principal junto con el resultado.
+    with _abrir_fuente(fuente) as archivo:
+        first = next(_lineas_crudas(archivo), None)
+    banco = detectar_banco(limpiar(first)) if first is not None else "DESCONOCIDO"
+    with usar_registro(RegistroTramos()) as registro:
+        datos, no_leidas = procesar_archivo_bancario(fuente)
+    tramos = [{**t, "archivo": nombre, "banco": banco} for t in registro.tramos()]
+    return nombre, banco, datos, no_leidas, tramos
+
+
+def procesar_lote_bancario(archivos, max_procesos=None, cache=None):
+    """Procesa varios archivos bancarios (de cualquier banco) en paralelo.
+
+    ``archivos`` es una lista de ``(nombre, fuente)``. Devuelve el índice combinado
+    ``{tin: campos}``, las líneas no leídas, los conflictos (mismo TIN con distinto
+    ``VOUCHER_Operacion_PSP`` en dos archivos; se conserva el primero) y un resumen
+    por archivo. Con ``cache`` (CacheParseo) los contenidos ya procesados no se
+    vuelven a leer; el resumen indica ``en_cache``, ``visto`` (primera carga previa:
+    archivo y fecha) y ``repetido_de`` si el mismo contenido vino dos veces en el lote.
+    """
+    with tramo("procesar_lote_bancario", archivos=len(archivos)) as t:
+        huellas = [huella_contenido(fuente) if cache else None for _, fuente in archivos]
+        parciales, pendientes, primero = [None] * len(archivos), [], {}
+        for i, (nombre, fuente) in enumerate(archivos):
+            h = huellas[i]
+            if h is not None and h in primero:
+                continue
+            if h is not None:
+                primero[h] = i
+            entrada = cache.obtener(h) if h is not None else None
+            if entrada is not None:
+                parciales[i] = (nombre, *entrada, [])
+            else:
+                pendientes.append(i)
+        t["en_cache"] = len(primero) - sum(1 for i in pendientes if huellas[i] is not None)
+
+        procesos = min(len(pendientes), max_procesos or _nucleos_disponibles())
+        t["procesos"] = max(procesos, 1)
+        if procesos <= 1:
+            nuevos = [_procesar_archivo_nombrado(*archivos[i]) for i in pendientes]
+        else:
+            with ProcessPoolExecutor(max_workers=procesos) as pool:
+                nuevos = list(pool.map(_procesar_archivo_nombrado, *zip(*(archivos[i] for i in pendientes))))
+        for i, parcial in zip(pendientes, nuevos):
+            parciales[i] = parcial
+            if huellas[i] is not None:
+                cache.guardar(huellas[i], *parcial[1:4])
+
+    indices, nombres, no_leidas, conflictos, resumen = [], [], [], [], []
+    for i, (nombre, _) in enumerate(archivos):
+        h = huellas[i]
+        if parciales[i] is None:
+            resumen.append({"archivo": nombre, "banco": None, "registros": 0, "no_leidas": 0,
+                            "repetido_de": archivos[primero[h]][0]})
+            continue
+        nombre, banco, parcial, no_leidas_archivo, tramos = parciales[i]
+        registro_actual().extender(tramos)
+        fila = {"archivo": nombre, "banco": banco, "registros": len(parcial), "no_leidas": len(no_leidas_archivo)}
+        if h is not None:
+            fila["en_cache"] = i not in pendientes
+            fila["visto"] = cache.visto(h)
+            cache.registrar_visto(h, nombre)
+        resumen.append(fila)
+        no_leidas.extend(f"[{nombre}] {ln}" if len(archivos) > 1 else ln for ln in no_leidas_archivo)
+        indices.append(parcial)
+        nombres.append(nombre)
+
+    datos, repetidos = IndiceTins.combinar(indices) if indices else (IndiceTins(), [])
+    for tin, i, j in sorted(repetidos, key=lambda r: (r[2], r[0])):
+        conflictos.append({
+            "tin": tin,
+            "archivo": nombres[i], "operacion": indices[i][tin]['VOUCHER_Operacion_PSP'],
+            "archivo_conflicto": nombres[j], "operacion_conflicto": indices[j][tin]['VOUCHER_Operacion_PSP'],
+        })
+    return datos, no_leidas, conflictos, resumen
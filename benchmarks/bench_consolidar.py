@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""consolidar_datos_tabla (columnar) frente a la versión anterior fila por fila.
+
+Uso: python benchmarks/bench_consolidar.py [--filas 1000 10000 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from engine import consolidar_datos_tabla  # noqa: E402
+
+
+# Versión anterior (dict por TIN + merges {**base, ...}), conservada como referencia.
+def consolidar_por_filas(resultados_api, datos_txt):
+    filas = []
+    pagados = []
+    ahora = datetime.now()
+    fecha_rev = f"{ahora.month}/{ahora.day}/{ahora.year}"
+    mes_rev = ahora.strftime("%B")
+
+    COLUMN_ORDER = [
+        "Tipo", "Tipo2", "Empresa", "Fecha de revision", "Mes",
+        "PSP_TIN", "PSP_TIN concatenado", "Estado", "Public ID",
+        "inv_id concatenado", "PEN", "Monto voucher", "Monto Kashio",
+        "Balance", "CANAL", "Banco", "Nro OP", "VOUCHER_FECHA"
+    ]
+
+    for res in resultados_api:
+        t, d = res["tin"], res["data"]
+        info_txt = datos_txt.get(t, {})
+        base = {
+            "Tipo": "Reg.Interna", "Tipo2": "EECC",
+            "Fecha de revision": fecha_rev, "Mes": mes_rev,
+            "PSP_TIN": t, "PSP_TIN concatenado": f"'{t}',",
+            "CANAL": "WEB",
+            "Banco": info_txt.get('VOUCHER_PSP', 'COMPLETAR_BANCO'),
+            "Nro OP": info_txt.get('VOUCHER_Operacion_PSP', 'COMPLETAR_OPERACION'),
+            "VOUCHER_FECHA": info_txt.get('VOUCHER_FECHA', 'COMPLETAR_FECHA'),
+        }
+        if d:
+            act_list = d.get("activity_list", [])
+            estado = act_list[0].get("name", "N/A") if (isinstance(act_list, list) and act_list) else "N/A"
+            if d.get("status") == "PAID":
+                pagados.append(t)
+            monto_voucher = float(d.get("sub_total", {}).get("value", 0.0)) if d.get("sub_total") else 0.0
+            monto_kashio = float(d.get("total", {}).get("value", 0.0)) if d.get("total") else 0.0
+            filas.append({**base,
+                "Empresa": d.get("creditor", {}).get("name", "N/A"),
+                "Estado": estado,
+                "Public ID": d.get("public_id", "N/A"),
+                "inv_id concatenado": f"'{d.get('public_id', 'N/A')}',",
+                "PEN": d.get("sub_total", {}).get("currency", "N/A"),
+                "Monto voucher": monto_voucher, "Monto Kashio": monto_kashio,
+                "Balance": monto_kashio - monto_voucher,
+            })
+        else:
+            filas.append({**base,
+                "Empresa": "ERROR EN CONSULTA",
+                "Estado": f"Error HTTP {res.get('error')}",
+                "Public ID": "N/A", "inv_id concatenado": "N/A", "PEN": "N/A",
+                "Monto voucher": 0.0, "Monto Kashio": 0.0, "Balance": 0.0,
+            })
+
+    return pd.DataFrame(filas)[COLUMN_ORDER], pagados
+
+
+def generar(n, semilla=7):
+    rnd = random.Random(semilla)
+    resultados, datos_txt = [], {}
+    for i in range(n):
+        tin = f"{100000000000 + i}"
+        if rnd.random() < 0.05:
+            resultados.append({"tin": tin, "data": None, "error": rnd.choice([404, 500, "timeout"])})
+        else:
+            monto = round(rnd.uniform(1, 900), 2)
+            resultados.append({"tin": tin, "error": None, "data": {
+                "public_id": f"inv_{i:08d}", "status": rnd.choice(["PAID", "UNPAID", "UNPAID"]),
+                "creditor": {"name": f"EMPRESA {i % 50}"},
+                "activity_list": [{"name": "CREATED"}] if i % 3 else [],
+                "sub_total": {"value": monto, "currency": "PEN"},
+                "total": {"value": monto + rnd.choice([0, 0, 3.5, 12]), "currency": "PEN"},
+            }})
+        if rnd.random() < 0.8:
+            datos_txt[tin] = {"VOUCHER_PSP": "BCP", "VOUCHER_Operacion_PSP": f"{i % 999999:06d}", "VOUCHER_FECHA": "46000"}
+    return resultados, datos_txt
+
+
+def _medir(fn, *args):
+    inicio = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - inicio, out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--filas", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    args = ap.parse_args()
+    for n in args.filas:
+        resultados, datos_txt = generar(n)
+        t_ant, (df_ant, pag_ant) = _medir(consolidar_por_filas, resultados, datos_txt)
+        t_nue, (df_nue, pag_nue) = _medir(consolidar_datos_tabla, resultados, datos_txt)
+        pd.testing.assert_frame_equal(df_ant, df_nue)
+        assert pag_ant == pag_nue
+        print(f"{n:>8,} filas  anterior {t_ant:7.3f} s  columnar {t_nue:7.3f} s  x{t_ant / t_nue:5.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Benchmark de punta a punta contra el servicio simulado (benchmarks/mock_server.py).
+
+Mide consultar_api_tins, ejecutar_post_pagos y los flujos EDT (api_upload_flow vía
+orquestar_cargas) en varios tamaños de lote: latencia p50/p95, throughput y tiempo total.
+
+Los pagos se miden repartidos en todas las cuentas y con mezclas realistas de pocas
+cuentas (MEZCLAS_PAGOS), donde manda el límite de envíos por cuenta.
+
+Uso: python benchmarks/bench_e2e.py [--lotes 100 500 2000] [--latencia-ms 40]
+     [--mezclas "solo BCP PEN"] [--max-p95-ms 500] [--json resultados.jsonl]
+Con --max-p95-ms el proceso termina con código 1 si algún p95 supera el umbral.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import engine  # noqa: E402
+import logic_processor  # noqa: E402
+from mock_server import CONFIG_DEFECTO, iniciar_en_hilo  # noqa: E402
+
+
+def _percentil(valores, q):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(q * len(valores)))] if valores else 0.0
+
+
+def _fila(caso, n, latencias_ms, segundos):
+    return {
+        "caso": caso, "n": n, "wall_s": round(segundos, 3),
+        "throughput_s": round(n / segundos, 1) if segundos else 0.0,
+        "p50_ms": round(_percentil(latencias_ms, 0.50), 1),
+        "p95_ms": round(_percentil(latencias_ms, 0.95), 1),
+    }
+
+
+def bench_consultas(n, concurrencia):
+    tins = [f"{700000000000 + i}" for i in range(n)]
+    inicio = time.perf_counter()
+    res = engine.consultar_api_tins(tins, concurrencia)
+    return _fila("consultar_api_tins", n, [r["latencia_ms"] for r in res], time.perf_counter() - inicio)
+
+
+# Mezclas de cuentas para ejecutar_post_pagos: nombre -> cuentas de DICT_ACC, repetidas según su peso.
+# Repartido en todas las cuentas se mide el servicio; con pocas cuentas el lote se serializa en
+# MAX_PAGOS_POR_CUENTA envíos por cuenta, que es lo que vive un lote real (casi todo BCP/IBK/BBVA PEN).
+MEZCLAS_PAGOS = {
+    "todas las cuentas": list(engine.DICT_ACC),
+    "BCP/IBK/BBVA PEN": [("BCP", "PEN")] * 6 + [("IBK", "PEN")] * 3 + [("BBVA", "PEN")],
+    "solo BCP PEN": [("BCP", "PEN")],
+}
+
+
+def bench_pagos(n, mezcla):
+    cuentas = MEZCLAS_PAGOS[mezcla]
+    payload = [{"VOUCHER_PSP": cuentas[i % len(cuentas)][0], "VOUCHER_PSP_TIN": f"{800000000000 + i}",
+                "VOUCHER_Currency": cuentas[i % len(cuentas)][1], "VOUCHER_Amount": 100.0,
+                "VOUCHER_Operacion_PSP": f"{i:06d}", "VOUCHER_FECHA": "46000"} for i in range(n)]
+    with tempfile.TemporaryDirectory() as tmp:
+        inicio = time.perf_counter()
+        df = engine.ejecutar_post_pagos(payload, "BENCH", ledger=os.path.join(tmp, "ledger.sqlite3"))
+        segundos = time.perf_counter() - inicio
+    # LATENCIA_MS mide solo session.post, no la espera por cupo de la cuenta; esa espera se ve en wall s.
+    return _fila(f"ejecutar_post_pagos ({mezcla})", n, df["LATENCIA_MS"].dropna().tolist(), segundos)
+
+
+def bench_cargas(n_archivos, lineas):
+    contenido = "".join(f"{i:08d}|REGISTRO EDT SIMULADO\n" for i in range(lineas)).encode()
+    archivos = [(f"sbp_{i}.txt", contenido, "udep" if i % 2 else "euro") for i in range(n_archivos)]
+    duraciones, inicios = [], {}
+    inicio = time.perf_counter()
+    for ev in logic_processor.orquestar_cargas(archivos):
+        if ev["tipo"] == "log" and ev["indice"] not in inicios:
+            inicios[ev["indice"]] = time.perf_counter()
+        elif ev["tipo"] == "fin":
+            duraciones.append((time.perf_counter() - inicios.get(ev["indice"], inicio)) * 1000)
+    return _fila(f"api_upload_flow ({lineas} líneas)", n_archivos, duraciones, time.perf_counter() - inicio)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--lotes", type=int, nargs="+", default=[100, 500, 2000])
+    ap.add_argument("--archivos", type=int, nargs="+", default=[2, 6])
+    ap.add_argument("--lineas-edt", type=int, default=500)
+    ap.add_argument("--mezclas", nargs="+", choices=list(MEZCLAS_PAGOS), default=list(MEZCLAS_PAGOS),
+                    help="mezclas de cuentas para los pagos")
+    ap.add_argument("--concurrencia", type=int, default=engine.MAX_CONSULTAS_SIMULTANEAS)
+    ap.add_argument("--latencia-ms", type=float, default=CONFIG_DEFECTO["latencia_ms"])
+    ap.add_argument("--tasa-error", type=float, default=CONFIG_DEFECTO["tasa_error"])
+    ap.add_argument("--max-p95-ms", type=float, help="falla si algún p95 de consultas/pagos supera este valor")
+    ap.add_argument("--json", help="agrega los resultados como JSON lines a este archivo")
+    args = ap.parse_args()
+
+    servidor, url = iniciar_en_hilo(latencia_ms=args.latencia_ms, tasa_error=args.tasa_error)
+    engine.SERVICE_URL = url
+    for flujo, prefijo in (("udep", "UDEP"), ("euro", "EUROMOTORS")):
+        logic_processor.ENDPOINTS[flujo] = {etapa: f"{url}/{prefijo}/{etapa}" for etapa in logic_processor.ENDPOINTS[flujo]}
+
+    filas = []
+    for n in args.lotes:
+        filas.append(bench_consultas(n, args.concurrencia))
+        for mezcla in args.mezclas:
+            filas.append(bench_pagos(n, mezcla))
+    for n in args.archivos:
+        filas.append(bench_cargas(n, args.lineas_edt))
+    servidor.shutdown()
+
+    print(f"{'caso':42} {'n':>6} {'wall s':>8} {'ops/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for f in filas:
+        print(f"{f['caso']:42} {f['n']:>6} {f['wall_s']:>8} {f['throughput_s']:>8} {f['p50_ms']:>8} {f['p95_ms']:>8}")
+    if args.json:
+        marca = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with open(args.json, "a", encoding="utf-8") as out:
+            for f in filas:
+                out.write(json.dumps({"fecha": marca, "latencia_servicio_ms": args.latencia_ms, **f}) + "\n")
+    if args.max_p95_ms is not None:
+        lentos = [f for f in filas if not f["caso"].startswith("api_upload_flow") and f["p95_ms"] > args.max_p95_ms]
+        for f in lentos:
+            print(f"REGRESIÓN: {f['caso']} n={f['n']} p95 {f['p95_ms']} ms > {args.max_p95_ms} ms", file=sys.stderr)
+        return 1 if lentos else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
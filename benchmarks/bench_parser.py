@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Throughput de procesar_archivo_bancario (líneas/seg) con archivos sintéticos.
+
+Antes de medir verifica CASOS_REGRESION (líneas que se leían mal) y sale con código 1 si alguno falla.
+
+Uso: python benchmarks/bench_parser.py [--lineas 1000000] [--bancos BCP IBK BBVA]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bank_parser import procesar_archivo_bancario  # noqa: E402
+
+FECHAS = ["20260105", "20260217", "20261130", "20270102"]
+
+
+def _tin(n):
+    # "9" + 11 dígitos con a lo más 6 significativos: no contiene fechas espurias.
+    return f"9{n % 1000000:011d}"
+
+
+def linea_bcp(n):
+    f = FECHAS[n % len(FECHAS)]
+    bloque = f"{f}{f}{'0' * 45}{n % 10 ** 12:012d}"
+    return f"DD191{'CLIENTE SINTETICO':<30} 00000000{_tin(n)} {bloque}EFECTIVO    "
+
+
+def linea_ibk(n):
+    f = FECHAS[n % len(FECHAS)]
+    return f"0791501 {'CLIENTE SINTETICO':<30} {_tin(n)} {f} 000000012500 {f}{n % 10 ** 8:08d}  "
+
+
+def linea_bbva(n):
+    f = FECHAS[n % len(FECHAS)]
+    return f"02{'CLIENTE SINTETICO':<30}{_tin(n)} 0845{n % 10 ** 6:06d}00000{f}  0000012500"
+
+
+# Líneas que antes se leían mal: (banco, línea, TIN, Nro OP, fecha serial esperados).
+CASOS_REGRESION = [
+    # El TIN contiene "20250115": la fecha se busca después del TIN (20260105 = 46027, no 45672).
+    ("IBK", f"0791501 {'CLIENTE SINTETICO':<30} 120250115999 20260105 000000012500 2026010500004321  ",
+     "120250115999", "4321", "46027"),
+    # El importe final contiene "20250301": la fecha va tras código de servicio, referencia y 5 ceros.
+    ("BBVA", f"02{'CLIENTE SINTETICO':<30}912345678901 0845123456000002026010500  0020250301",
+     "912345678901", "123456", "46027"),
+]
+
+
+def verificar_casos():
+    fallidos = 0
+    for banco, linea, tin, operacion, fecha in CASOS_REGRESION:
+        datos, _ = procesar_archivo_bancario(generar_con(banco, [linea]))
+        obtenido = datos.get(tin)
+        esperado = {"VOUCHER_PSP": banco, "VOUCHER_Operacion_PSP": operacion, "VOUCHER_FECHA": fecha}
+        if not obtenido or any(obtenido.get(k) != v for k, v in esperado.items()):
+            print(f"FALLA {banco} {tin}: esperado {esperado}, obtenido {obtenido}", file=sys.stderr)
+            fallidos += 1
+    return fallidos
+
+
+GENERADORES = {
+    "BCP": ("CC1910000000000000", linea_bcp),
+    "IBK": ("0791501CABECERA", linea_ibk),
+    "BBVA": ("0120CABECERA", linea_bbva),
+}
+
+
+def generar(banco, n):
+    return generar_con(banco, [GENERADORES[banco][1](i) for i in range(n)])
+
+
+def generar_con(banco, lineas):
+    return ("\r\n".join([GENERADORES[banco][0]] + lineas) + "\r\n").encode("latin-1")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--lineas", type=int, default=1_000_000)
+    ap.add_argument("--bancos", nargs="+", default=list(GENERADORES))
+    args = ap.parse_args()
+    if verificar_casos():
+        sys.exit(1)
+    for banco in args.bancos:
+        contenido = generar(banco, args.lineas)
+        inicio = time.perf_counter()
+        datos, no_leidas = procesar_archivo_bancario(contenido)
+        seg = time.perf_counter() - inicio
+        print(f"{banco:5} {args.lineas:>10,} líneas  {len(contenido) / 1e6:8.1f} MB  "
+              f"{seg:7.2f} s  {args.lineas / seg:>12,.0f} líneas/s  "
+              f"TIN únicos {len(datos):,}  índice {datos.nbytes() / 1e6:.1f} MB  no leídas {len(no_leidas):,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Enrutamiento de archivos EDT a suscripciones y conteo de líneas.
+
+Compara find_subscription_id (EnrutadorSuscripciones compilado) con el recorrido
+lineal anterior sobre un corpus sintético de nombres, con las reglas reales y con un
+juego grande de reglas; verifica que ambos den el mismo resultado. También mide
+contar_lineas frente a splitlines().
+
+Uso: python benchmarks/bench_routing.py [--nombres 200000] [--reglas 300] [--mb 64]
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logic_processor import REGLAS_POR_FLUJO, contar_lineas, find_subscription_id  # noqa: E402
+
+
+# Versión anterior, conservada como referencia.
+def find_subscription_id_lineal(filename, rules_list):
+    fname_lower = filename.lower()
+    for sub_id, inc, exc in rules_list:
+        if any(i in fname_lower for i in inc) and not any(e in fname_lower for e in exc):
+            return sub_id
+    return None
+
+
+def reglas_sinteticas(n):
+    # Dos términos incluidos por regla, exclusiones en una de cada tres y términos que
+    # son prefijo de otros (rec/recibo) para ejercitar los solapamientos.
+    reglas = [(f"sub_{i:05d}", [f"k{i:03d}x", f"z{i:03d}q"], [f"no{i}"] if i % 3 == 0 else []) for i in range(n)]
+    return [("sub_rec", ["rec"], ["recibo"]), ("sub_recibo", ["recibo"], [])] + reglas
+
+
+def corpus(reglas, n, semilla=7):
+    rnd = random.Random(semilla)
+    terminos = [t for _, inc, exc in reglas for t in (*inc, *exc)]
+    nombres = []
+    for _ in range(n):
+        base = "".join(rnd.choices(string.ascii_lowercase + string.digits + "_", k=rnd.randint(10, 40)))
+        for _ in range(rnd.choice((0, 1, 1, 2))):
+            k = rnd.randint(0, len(base))
+            base = base[:k] + rnd.choice(terminos) + base[k:]
+        nombres.append((base.upper() if rnd.random() < 0.3 else base) + ".txt")
+    return nombres
+
+
+def medir(etiqueta, reglas, nombres):
+    find_subscription_id(nombres[0], reglas)  # compila fuera de la medición
+    inicio = time.perf_counter()
+    lineal = [find_subscription_id_lineal(n, reglas) for n in nombres]
+    t_lineal = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    compilado = [find_subscription_id(n, reglas) for n in nombres]
+    t_compilado = time.perf_counter() - inicio
+    assert compilado == lineal, "el enrutador compilado difiere del recorrido lineal"
+    enrutados = sum(1 for s in compilado if s)
+    print(f"{etiqueta:18} {len(reglas):>5} reglas  {len(nombres):>8,} nombres  "
+          f"lineal {len(nombres) / t_lineal:>12,.0f}/s  compilado {len(nombres) / t_compilado:>12,.0f}/s  "
+          f"x{t_lineal / t_compilado:5.1f}  enrutados {enrutados:,}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--nombres", type=int, default=200_000)
+    ap.add_argument("--reglas", type=int, default=300)
+    ap.add_argument("--mb", type=int, default=64, help="tamaño del archivo EDT sintético para el conteo de líneas")
+    args = ap.parse_args()
+
+    for flujo, reglas in REGLAS_POR_FLUJO.items():
+        medir(flujo, reglas, corpus(reglas, args.nombres))
+    grandes = reglas_sinteticas(args.reglas)
+    medir("sintéticas", grandes, corpus(grandes, args.nombres))
+
+    linea = b"00012345|REGISTRO EDT SIMULADO|000000100.00|20260101\r\n"
+    contenido = linea * (args.mb * 1024 * 1024 // len(linea))
+    inicio = time.perf_counter()
+    esperado = len(contenido.splitlines())
+    t_split = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    contado = contar_lineas(contenido)
+    t_bytes = time.perf_counter() - inicio
+    assert contado == esperado
+    print(f"conteo de líneas   {len(contenido) / 1e6:.0f} MB  splitlines {t_split * 1000:8.1f} ms  "
+          f"contar_lineas {t_bytes * 1000:8.1f} ms  x{t_split / t_bytes:5.1f}")
+
+
+if __name__ == "__main__":
+    main()
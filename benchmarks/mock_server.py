@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Servicio local que imita KashIO (/consultar, /pagomanual) y los flujos EDT de
+UDEP/EUROMOTORS (subir, procesar, sincronizar, reconciliar) para medir rendimiento.
+
+Uso: python benchmarks/mock_server.py --puerto 8800 --latencia-ms 40 --tasa-error 0.02
+
+Latencia, errores y la velocidad con que "avanza" el procesamiento asíncrono son
+configurables. Los endpoints de flujo son /<FLUJO>/<etapa>, p.ej. /UDEP/subir.
+"""
+import argparse
+import email.parser
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONFIG_DEFECTO = {
+    "latencia_ms": 40.0,       # media de la latencia por request
+    "jitter_ms": 20.0,         # desviación (uniforme +-)
+    "tasa_error": 0.0,         # fracción de requests que devuelven 500
+    "tasa_429": 0.0,           # fracción de requests que devuelven 429 con Retry-After
+    "retry_after_s": 1.0,
+    "tasa_pagado": 0.05,       # fracción de TIN que responden status PAID
+    "tasa_fallidos": 0.1,      # fracción de registros EDT que terminan como fallidos
+    "registros_por_seg": 200,  # avance del procesamiento asíncrono tras /procesar
+}
+
+
+class EstadoFlujo:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.registros = 0
+        self.fallidos = 0
+        self.inicio = None
+
+
+def crear_servidor(puerto=0, **config):
+    """Crea el servidor (sin iniciarlo). ``puerto=0`` elige uno libre."""
+    cfg = {**CONFIG_DEFECTO, **config}
+    flujos = {}
+    flujos_lock = threading.Lock()
+
+    def estado(flujo):
+        with flujos_lock:
+            return flujos.setdefault(flujo, EstadoFlujo())
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _responder(self, code, obj, cabeceras=None):
+            cuerpo = json.dumps(obj).encode()
+            self.send_response(code)
+            for clave, valor in (cabeceras or {}).items():
+                self.send_header(clave, valor)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def _simular(self):
+            time.sleep(max(0.0, cfg["latencia_ms"] + random.uniform(-1, 1) * cfg["jitter_ms"]) / 1000)
+            azar = random.random()
+            if azar < cfg["tasa_error"]:
+                self._responder(500, {"message": "error simulado"})
+                return False
+            if azar < cfg["tasa_error"] + cfg["tasa_429"]:
+                self._responder(429, {"message": "Too Many Requests"}, {"Retry-After": f"{cfg['retry_after_s']:g}"})
+                return False
+            return True
+
+        def _cuerpo(self):
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        def do_GET(self):
+            if not self.path.startswith("/consultar/"):
+                return self._responder(404, {"message": "no encontrado"})
+            if not self._simular():
+                return
+            tin = self.path.split("/consultar/", 1)[1].split("?", 1)[0]
+            semilla = random.Random(tin)
+            monto = round(semilla.uniform(10, 900), 2)
+            self._responder(200, {
+                "public_id": f"inv_{tin}",
+                "status": "PAID" if semilla.random() < cfg["tasa_pagado"] else "UNPAID",
+                "creditor": {"name": "EMPRESA SIMULADA"},
+                "activity_list": [{"name": "CREATED"}],
+                "sub_total": {"value": monto, "currency": "PEN"},
+                "total": {"value": monto + semilla.choice([0, 0, 0, 6.5]), "currency": "PEN"},
+            })
+
+        def do_POST(self):
+            cuerpo = self._cuerpo()
+            if not self._simular():
+                return
+            if self.path == "/pagomanual":
+                return self._responder(200, {"message": "OK"})
+            partes = self.path.strip("/").split("/")
+            if len(partes) != 2:
+                return self._responder(404, {"message": "no encontrado"})
+            flujo, etapa = estado(partes[0]), partes[1]
+            with flujo.lock:
+                if etapa == "subir":
+                    mensaje = email.parser.BytesParser().parsebytes(
+                        b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + cuerpo)
+                    edt = next((p.get_payload(decode=True) for p in mensaje.get_payload()
+                                if p.get_param("name", header="content-disposition") == "edt"), b"")
+                    flujo.registros = len(edt.splitlines())
+                    flujo.fallidos = int(flujo.registros * cfg["tasa_fallidos"])
+                    flujo.inicio = None
+                    return self._responder(200, {"message": "subido"})
+                if etapa == "procesar":
+                    flujo.inicio = time.monotonic()
+                    return self._responder(200, {"processes": [{"steps": [
+                        {"processed_record": flujo.registros - flujo.fallidos, "failed_record": flujo.fallidos}]}]})
+                avance = 0 if flujo.inicio is None else (time.monotonic() - flujo.inicio) * cfg["registros_por_seg"]
+                if etapa == "sincronizar":
+                    hechos = min(flujo.registros, int(avance))
+                    fallidos = min(flujo.fallidos, hechos)
+                    return self._responder(200, {"processed_record": hechos - fallidos, "failed_record": fallidos})
+                if etapa == "reconciliar":
+                    listos = min(flujo.fallidos, int(avance / max(flujo.registros, 1) * flujo.fallidos))
+                    return self._responder(200, [f"id_{i}" for i in range(listos)])
+            self._responder(404, {"message": "etapa desconocida"})
+
+    return ThreadingHTTPServer(("127.0.0.1", puerto), Handler)
+
+
+def iniciar_en_hilo(**config):
+    """Inicia el servidor en un hilo daemon y devuelve (servidor, url_base)."""
+    servidor = crear_servidor(**config)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}"
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--puerto", type=int, default=8800)
+    for clave, valor in CONFIG_DEFECTO.items():
+        ap.add_argument(f"--{clave.replace('_', '-')}", type=float, default=valor)
+    args = vars(ap.parse_args())
+    servidor = crear_servidor(args.pop("puerto"), **args)
+    print(f"Servicio simulado en http://127.0.0.1:{servidor.server_address[1]}", flush=True)
+    servidor.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
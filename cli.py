@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Conciliación KashIO sin navegador: TINs + archivos bancarios -> reporte Excel/CSV/Parquet.
+
+Uso:
+    python cli.py --tins tins.txt --bancos BCP_0101.txt IBK_0101.txt --salida reporte.xlsx
+    cat tins.txt | python cli.py --tins - --salida reporte.csv
+"""
+import argparse
+import sys
+import time
+
+import engine
+from telemetry import RegistroTramos, usar_registro
+
+
+def _leer_tins(ruta):
+    if ruta == "-":
+        return engine.extraer_tins(sys.stdin.read())
+    with open(ruta, encoding="utf-8", errors="replace") as f:
+        return engine.extraer_tins(f.read())
+
+
+def _progreso(etiqueta):
+    def reportar(hechos, total):
+        if hechos == total or hechos % 100 == 0:
+            print(f"\r{etiqueta}: {hechos}/{total}", end="" if hechos < total else "\n", file=sys.stderr, flush=True)
+    return reportar
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--tins", required=True, help="archivo con los códigos TIN ('-' para stdin)")
+    ap.add_argument("--bancos", nargs="*", default=[], help="archivos bancarios (BCP/IBK/BBVA)")
+    ap.add_argument("--salida", required=True, help="reporte .xlsx, .csv o .parquet")
+    ap.add_argument("--concurrencia", type=int, default=engine.MAX_CONSULTAS_SIMULTANEAS)
+    ap.add_argument("--forzar", action="store_true", help="ignorar la cache de consultas")
+    ap.add_argument("--metricas", help="agregar los tiempos por etapa a este archivo JSONL")
+    args = ap.parse_args(argv)
+    args.formato = args.salida.rsplit(".", 1)[-1].lower()
+    if args.formato not in engine.FORMATOS_EXPORTACION:
+        ap.error(f"--salida debe terminar en {', '.join('.' + f for f in engine.FORMATOS_EXPORTACION)}: {args.salida}")
+    with usar_registro(RegistroTramos()) as registro:
+        codigo = _conciliar(args)
+    if args.metricas:
+        with open(args.metricas, "a", encoding="utf-8") as f:
+            f.write(registro.a_jsonl())
+    for fila in registro.resumen():
+        print(f"  {fila['etapa']}: {fila['total_ms']} ms · {fila['requests']} req · {fila['bytes']} bytes", file=sys.stderr)
+    return codigo
+
+
+def _conciliar(args):
+    tins = _leer_tins(args.tins)
+    if not tins:
+        print("No se identificaron códigos TIN con la longitud requerida (12 dígitos).", file=sys.stderr)
+        return 2
+
+    inicio = time.perf_counter()
+    cache_parseo = engine.CacheParseo(ruta_sqlite=engine.CACHE_PARSEO)
+    datos_txt, no_leidas, conflictos, resumen = engine.procesar_lote_bancario([(ruta, ruta) for ruta in args.bancos], cache=cache_parseo)
+    for r in resumen:
+        if r.get("repetido_de"):
+            print(f"{r['archivo']}: idéntico a {r['repetido_de']}, ignorado", file=sys.stderr)
+            continue
+        origen = " (cache)" if r.get("en_cache") else ""
+        print(f"{r['archivo']}: {r['banco']} · {r['registros']} registros · {r['no_leidas']} no leídas{origen}", file=sys.stderr)
+        if r.get("visto") and r["visto"][0] != r["archivo"]:
+            print(f"  aviso: mismo contenido que {r['visto'][0]}, cargado el {time.strftime('%d/%m/%Y %H:%M', time.localtime(r['visto'][1]))}",
+                  file=sys.stderr)
+    if no_leidas:
+        print(f"{len(no_leidas)} línea(s) bancarias no leídas (no incluidas en la conciliación)", file=sys.stderr)
+    for c in conflictos:
+        print(f"Conflicto TIN {c['tin']}: {c['archivo']}={c['operacion']} / {c['archivo_conflicto']}={c['operacion_conflicto']}", file=sys.stderr)
+
+    cache = engine.CacheConsultas(ruta_sqlite=engine.CACHE_SQLITE)
+    resultados = engine.consultar_api_tins(tins, args.concurrencia, cache=cache, forzar=args.forzar, progreso=_progreso("Consultas"))
+    df, pagados = engine.consolidar_datos_tabla(resultados, datos_txt)
+
+    with open(args.salida, "wb") as f:
+        f.write(engine.exportar_reporte(df, args.formato))
+
+    errores = sum(1 for r in resultados if not r["data"])
+    lat = engine.resumen_latencias(resultados)
+    print(f"{len(df)} filas -> {args.salida} en {time.perf_counter() - inicio:.1f}s · "
+          f"{errores} con error · {len(pagados)} PAID · cache {cache.hits}/{cache.hits + cache.misses}", file=sys.stderr)
+    if lat:
+        print(f"Latencia p50 {lat['p50']} ms · p95 {lat['p95']} ms · máx {lat['max']} ms", file=sys.stderr)
+    if pagados:
+        print(f"PAID: {', '.join(pagados)}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
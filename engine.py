@@ -0,0 +1,775 @@
+# -*- coding: utf-8 -*-
+"""Motor de conciliación KashIO, sin dependencias de Streamlit.
+
+Consulta de TIN, conciliación con el índice de archivos bancarios, alertas, trama y
+ejecución de pagos. pandas y requests se importan dentro de las funciones que los
+usan para que importar el módulo (CLI, jobs) sea inmediato.
+"""
+import ast
+import contextvars
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime
+
+from bank_parser import (  # noqa: F401  (API del motor)
+    CACHE_PARSEO, CacheParseo, IndiceTins, huella_contenido, procesar_archivo_bancario, procesar_lote_bancario,
+)
+from telemetry import tramo
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional: mismo resultado con json, más lento
+    orjson = None
+
+
+# ==========================================
+# Configuración
+# ==========================================
+SERVICE_URL = os.environ.get("KASHIO_SERVICE_URL", "https://t5jezcpiwc.execute-api.us-east-1.amazonaws.com/LIVE")
+HEADERS = {'content-type': 'application/json'}
+AUTH_USER = ""
+AUTH_PSW = ""
+
+DICT_ACC = {
+    ('BCP',              'PEN'): 'acc_R8eMfP7Cdaq5ScUavLXBMX',
+    ('BCP',              'USD'): 'acc_ddcdxWdBFhtwhWMJQKZ46h',
+    ('BBVA',             'PEN'): 'acc_cZpQmjzkKdoEvmWfj4Qm9K',
+    ('BBVA',             'USD'): 'acc_S6tfrAUEnLcH2VNDiGt9d9',
+    ('IBK',              'PEN'): 'acc_rbzSXQuvc5FfMbR2z4vMGd',
+    ('IBK',              'USD'): 'acc_9FmSeoNUiQTL7bHd2JzJCb',
+    ('SCOTIA',           'PEN'): 'acc_R8eMfP7Cdaq5ScUavLXBMS',
+    ('SCOTIA',           'USD'): 'acc_cUtpw5swumqQRZDRZEcy23',
+    ('KASNET',           'PEN'): 'acc_5w9ujngtRTf8qgG7xYyMJm',
+    ('BILLETERA-NIUBIZ', 'PEN'): 'acc_KCKUEA8gNiAk9r73zz6NMh',
+    ('CARD',             'PEN'): 'acc_8v3EMCq7EuuK2Czp54KF6e',
+    ('BILLETERA-GMONEY', 'PEN'): 'acc_24205fe371034deb9731',
+}
+
+
+# ==========================================
+# Consulta de TIN
+# ==========================================
+# Consultas simultáneas contra /consultar. Ajustar con las latencias p50/p95 que se
+# muestran tras cada consulta (latencia alta y estable => subir; errores 429 => bajar).
+MAX_CONSULTAS_SIMULTANEAS = 16
+
+
+def _nueva_sesion(headers, pool_size):
+    from requests.adapters import HTTPAdapter
+
+    from http_client import SesionResiliente
+
+    session = SesionResiliente()
+    session.auth = (AUTH_USER, AUTH_PSW)
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _consultar_tin(session, tin):
+    inicio = time.perf_counter()
+    try:
+        r = session.get(f"{SERVICE_URL}/consultar/{tin}?search_by=PSP_TIN", timeout=15)
+        data = r.json() if r.status_code in (200, 201) else None
+        res = {"tin": tin, "data": data, "error": None if data else r.status_code, "bytes": len(r.content)}
+    except Exception as e:
+        res = {"tin": tin, "data": None, "error": str(e), "bytes": 0}
+    res["latencia_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+    return res
+
+
+CACHE_TTL_SEGUNDOS = 15 * 60
+CACHE_MAX_ENTRADAS = 20000
+CACHE_SQLITE = os.environ.get("KASHIO_CACHE_CONSULTAS")  # None => solo memoria
+
+
+class CacheConsultas:
+    """Respuestas de /consultar por TIN con TTL y desalojo LRU.
+
+    Solo se guardan respuestas válidas; los errores siempre se vuelven a consultar.
+    Si se indica ``ruta_sqlite`` las entradas también se persisten en disco.
+    """
+
+    def __init__(self, ttl=CACHE_TTL_SEGUNDOS, max_entradas=CACHE_MAX_ENTRADAS, ruta_sqlite=None):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.ruta_sqlite = ruta_sqlite
+        self.hits = 0
+        self.misses = 0
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self._con = None
+        if ruta_sqlite:
+            # Una sola conexión para toda la vida de la cache; _lock serializa su uso entre hilos.
+            self._con = sqlite3.connect(ruta_sqlite, timeout=30, check_same_thread=False)
+            with self._con:
+                self._con.execute("CREATE TABLE IF NOT EXISTS consultas (tin TEXT PRIMARY KEY, guardado REAL, data TEXT)")
+                self._con.execute("CREATE INDEX IF NOT EXISTS consultas_guardado ON consultas (guardado)")
+
+    def obtener(self, tin):
+        ahora = time.time()
+        with self._lock:
+            entrada = self._datos.get(tin)
+            if entrada is None and self._con:
+                fila = self._con.execute("SELECT guardado, data FROM consultas WHERE tin = ?", (tin,)).fetchone()
+                if fila:
+                    entrada = self._datos[tin] = (fila[0], json.loads(fila[1]))
+            if entrada is None or ahora - entrada[0] > self.ttl:
+                self._datos.pop(tin, None)
+                self.misses += 1
+                return None
+            self._datos.move_to_end(tin)
+            self.hits += 1
+            return entrada[1]
+
+    def guardar(self, tin, data):
+        self.guardar_varios([(tin, data)])
+
+    def guardar_varios(self, pares):
+        # Todas las respuestas de una consulta en una transacción; los vencidos se purgan una vez.
+        pares = list(pares)
+        if not pares:
+            return
+        guardado = time.time()
+        with self._lock:
+            for tin, data in pares:
+                self._datos[tin] = (guardado, data)
+                self._datos.move_to_end(tin)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+            if self._con:
+                with self._con:
+                    self._con.executemany("INSERT OR REPLACE INTO consultas VALUES (?, ?, ?)",
+                                          [(tin, guardado, json.dumps(data)) for tin, data in pares])
+                    self._con.execute("DELETE FROM consultas WHERE guardado < ?", (guardado - self.ttl,))
+
+    def invalidar(self, tins):
+        with self._lock:
+            for tin in tins:
+                self._datos.pop(tin, None)
+
+
+def consultar_api_tins(tin_list, max_workers=MAX_CONSULTAS_SIMULTANEAS, cache=None, forzar=False, progreso=None):
+    # Los resultados conservan el orden de tin_list aunque las respuestas lleguen desordenadas.
+    # Con cache, solo los TIN ausentes o vencidos llegan al servicio (forzar=True los consulta todos).
+    # progreso(hechos, total) se llama desde el hilo que invoca la función.
+    with tramo("consultar_api_tins", tins=len(tin_list)) as t:
+        resultados = [None] * len(tin_list)
+        pendientes = []
+        for idx, tin in enumerate(tin_list):
+            data = cache.obtener(tin) if (cache and not forzar) else None
+            if data is not None:
+                resultados[idx] = {"tin": tin, "data": data, "error": None, "latencia_ms": None, "cache": True}
+            else:
+                pendientes.append(idx)
+        t["cache_hits"] = len(tin_list) - len(pendientes)
+        if not pendientes:
+            return resultados
+        workers = max(1, min(max_workers, len(pendientes)))
+        headers = {**HEADERS, 'User-Agent': 'PostmanRuntime/7.26.8'}
+        with _nueva_sesion(headers, workers) as session, ThreadPoolExecutor(max_workers=workers) as pool:
+            # Cada tarea lleva una copia del contexto para que los reintentos sumen al tramo.
+            futuros = {pool.submit(contextvars.copy_context().run, _consultar_tin, session, tin_list[idx]): idx for idx in pendientes}
+            for hechos, fut in enumerate(as_completed(futuros), 1):
+                res = {**fut.result(), "cache": False}
+                t["requests"] += 1
+                t["bytes"] += res["bytes"]
+                resultados[futuros[fut]] = res
+                if progreso:
+                    progreso(hechos, len(pendientes))
+        if cache:
+            cache.guardar_varios((resultados[idx]["tin"], resultados[idx]["data"]) for idx in pendientes if resultados[idx]["data"])
+        t["errores_http"] = sum(1 for idx in pendientes if not resultados[idx]["data"])
+        return resultados
+
+
+def tins_pagados(resultados):
+    """TIN cuyo estado actual en /consultar es PAID; no se les vuelve a pagar."""
+    return [r["tin"] for r in resultados if r and r["data"] and r["data"].get("status") == "PAID"]
+
+
+def resumen_latencias(resultados):
+    lat = sorted(r["latencia_ms"] for r in resultados if r and r.get("latencia_ms") is not None)
+    if not lat:
+        return None
+    pct = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))]
+    return {"n": len(lat), "p50": pct(0.50), "p95": pct(0.95), "max": lat[-1]}
+
+
+# ==========================================
+# Pagos
+# ==========================================
+# Pagos simultáneos en total y por cuenta PSP (par (PSP, moneda) de DICT_ACC).
+MAX_PAGOS_SIMULTANEOS = 8
+MAX_PAGOS_POR_CUENTA = 2
+# Registro local de pagos confirmados: un reintento tras caída o recarga no vuelve a enviarlos.
+LEDGER_PAGOS = os.environ.get("KASHIO_LEDGER_PAGOS", "ledger_pagos.sqlite3")
+# Status de una clave reservada cuyo pago aún no respondió. Si el proceso muere a mitad de un
+# envío la reserva queda: esa operación no se reenvía sola y hay que revisarla a mano.
+EN_CURSO = "EN_CURSO"
+_ledger_lock = threading.Lock()
+
+
+def clave_idempotencia(item):
+    return f"{item.get('VOUCHER_PSP_TIN', 'N/A')}:{item.get('VOUCHER_Operacion_PSP', '')}"
+
+
+def _ledger_conectar(ruta):
+    con = sqlite3.connect(ruta, timeout=30)
+    con.execute("CREATE TABLE IF NOT EXISTS pagos (clave TEXT PRIMARY KEY, tin TEXT, status TEXT, usuario TEXT, fecha TEXT)")
+    return con
+
+
+def _ledger_estados(ruta, claves):
+    # {clave: status} de las claves presentes en el ledger ("200" pagado, EN_CURSO reservado).
+    if not claves:
+        return {}
+    claves, estados = list(claves), {}
+    with _ledger_lock, _ledger_conectar(ruta) as con:
+        for i in range(0, len(claves), 500):
+            lote = claves[i:i + 500]
+            estados.update(con.execute(f"SELECT clave, status FROM pagos WHERE clave IN ({','.join('?' * len(lote))})", lote))
+    return estados
+
+
+def _ledger_reservar(ruta, clave, tin, usuario):
+    """Reserva la clave antes de enviar el pago: devuelve None si quedó reservada o el status
+    que ya tenía. La inserción es atómica, así que dos envíos simultáneos no pasan ambos."""
+    with _ledger_lock, _ledger_conectar(ruta) as con:
+        if con.execute("INSERT OR IGNORE INTO pagos VALUES (?, ?, ?, ?, ?)",
+                       (clave, tin, EN_CURSO, usuario, datetime.now().isoformat(timespec="seconds"))).rowcount:
+            return None
+        return con.execute("SELECT status FROM pagos WHERE clave = ?", (clave,)).fetchone()[0]
+
+
+def _ledger_registrar(ruta, clave, status):
+    with _ledger_lock, _ledger_conectar(ruta) as con:
+        con.execute("UPDATE pagos SET status = ?, fecha = ? WHERE clave = ?",
+                    (str(status), datetime.now().isoformat(timespec="seconds"), clave))
+
+
+def _ledger_liberar(ruta, clave):
+    with _ledger_lock, _ledger_conectar(ruta) as con:
+        con.execute("DELETE FROM pagos WHERE clave = ? AND status = ?", (clave, EN_CURSO))
+
+
+def fila_pagado(tin):
+    return {'TIN': tin, 'STATUS': 'PAID', 'MENSAJE': 'Ya figura como PAID en la consulta; no se envía'}
+
+
+def _fila_ledger(tin, status):
+    if status == EN_CURSO:
+        return {'TIN': tin, 'STATUS': EN_CURSO, 'MENSAJE': 'La misma operación se está enviando en otro proceso'}
+    return {'TIN': tin, 'STATUS': 'YA_PAGADO', 'MENSAJE': 'Registrado como pagado en una ejecución previa'}
+
+
+def _post_pago(session, item, acc, usuario_operacion, clave, ledger):
+    tin = item.get('VOUCHER_PSP_TIN', 'N/A')
+    res_row = {'TIN': tin, 'STATUS': None, 'MENSAJE': None}
+    payload = {
+        "invoice": {"id": tin},
+        "payer": {"reference_number": tin},
+        "amount": {"value": float(item.get('VOUCHER_Amount', 0)), "currency": item.get('VOUCHER_Currency')},
+        "psp_account": {"id": acc},
+        "operation_no": item.get('VOUCHER_Operacion_PSP'),
+        "operation_date": item.get('VOUCHER_FECHA'),
+        "branch_code": "",
+        "channel_code": "WEB",
+        "force_expire_payment": True,
+        "metadata": {"code": usuario_operacion, "clave": "AR"}
+    }
+    if ledger:
+        previo = _ledger_reservar(ledger, clave, tin, usuario_operacion)
+        if previo is not None:
+            return _fila_ledger(tin, previo)
+    inicio = time.perf_counter()
+    try:
+        # No idempotente: un 504/timeout puede llegar con el pago ya hecho; solo se reintentan 429/503.
+        resp = session.post(f"{SERVICE_URL}/pagomanual", timeout=30, json=payload, headers={'Idempotency-Key': clave},
+                            idempotente=False)
+        res_row['STATUS'] = resp.status_code
+        res_row['MENSAJE'] = 'OK' if resp.status_code == 200 else resp.text
+        res_row['_bytes'] = len(resp.request.body or b"") + len(resp.content)
+    except Exception as e:
+        res_row['STATUS'] = 'ERROR_RED'
+        res_row['MENSAJE'] = str(e)
+    # Solo la llamada (con sus reintentos), sin la espera en cola: comparable con latencia_ms de las consultas.
+    res_row['LATENCIA_MS'] = round((time.perf_counter() - inicio) * 1000, 1)
+    if ledger:
+        if res_row['STATUS'] == 200:
+            _ledger_registrar(ledger, clave, res_row['STATUS'])
+        else:
+            _ledger_liberar(ledger, clave)
+    return res_row
+
+
+def ejecutar_post_pagos(payload_list, usuario_operacion, ledger=LEDGER_PAGOS, progreso=None):
+    import pandas as pd
+
+    with tramo("ejecutar_post_pagos", registros=len(payload_list)) as t:
+        resultados = _ejecutar_post_pagos(payload_list, usuario_operacion, ledger, progreso, t)
+    return pd.DataFrame(resultados)
+
+
+def _ejecutar_post_pagos(payload_list, usuario_operacion, ledger, progreso, t):
+    resultados = [None] * len(payload_list)
+    claves = [clave_idempotencia(item) for item in payload_list]
+    en_ledger = _ledger_estados(ledger, set(claves)) if ledger else {}
+    colas = {}  # cuenta -> índices por enviar, en orden
+    enviados = set()
+    for index, item in enumerate(payload_list):
+        tin = item.get('VOUCHER_PSP_TIN', 'N/A')
+        cuenta = (item.get('VOUCHER_PSP'), item.get('VOUCHER_Currency'))
+        if cuenta not in DICT_ACC:
+            resultados[index] = {'TIN': tin, 'STATUS': 'FALTA_CUENTA', 'MENSAJE': 'PSP/Moneda no configurado'}
+        elif claves[index] in en_ledger:
+            resultados[index] = _fila_ledger(tin, en_ledger[claves[index]])
+        elif claves[index] in enviados:
+            resultados[index] = {'TIN': tin, 'STATUS': 'DUPLICADO', 'MENSAJE': 'Misma operación repetida en la trama'}
+        else:
+            enviados.add(claves[index])
+            colas.setdefault(cuenta, deque()).append(index)
+    t["omitidos"] = len(payload_list) - len(enviados)
+    hechos = t["omitidos"]
+
+    # Se agenda por cuenta: cada una tiene a lo sumo MAX_PAGOS_POR_CUENTA pagos en el pool y el
+    # siguiente se envía al terminar uno. Ningún hilo queda esperando turno de una cuenta ocupada.
+    with _nueva_sesion(HEADERS, MAX_PAGOS_SIMULTANEOS) as session, ThreadPoolExecutor(max_workers=MAX_PAGOS_SIMULTANEOS) as pool:
+        futuros = {}
+
+        def enviar(cuenta):
+            index = colas[cuenta].popleft()
+            futuros[pool.submit(contextvars.copy_context().run, _post_pago, session, payload_list[index], DICT_ACC[cuenta],
+                                usuario_operacion, claves[index], ledger)] = (index, cuenta)
+
+        for cuenta, cola in colas.items():
+            for _ in range(min(MAX_PAGOS_POR_CUENTA, len(cola))):
+                enviar(cuenta)
+        while futuros:
+            listos, _ = wait(futuros, return_when=FIRST_COMPLETED)
+            for fut in listos:
+                index, cuenta = futuros.pop(fut)
+                if colas[cuenta]:
+                    enviar(cuenta)
+                res_row = fut.result()
+                t["requests"] += 'LATENCIA_MS' in res_row  # las filas que el ledger frenó no llamaron
+                t["bytes"] += res_row.pop('_bytes', 0)
+                resultados[index] = res_row
+                hechos += 1
+                if progreso:
+                    progreso(hechos, len(payload_list))
+    return resultados
+
+
+# ==========================================
+# Entrada
+# ==========================================
+def extraer_tins(texto):
+    # Códigos de 12 dígitos (se acepta el prefijo "00" de 14 dígitos), sin repetir y en orden.
+    candidatos = re.findall(r'\d+', texto)
+    tins_validos = [t[2:] if (t.startswith("00") and len(t) > 12) else t for t in candidatos if len(t) == 12 or (t.startswith("00") and len(t[2:]) == 12)]
+    return list(dict.fromkeys(tins_validos))
+
+
+# ==========================================
+# Conciliación
+# ==========================================
+COLUMN_ORDER = [
+    "Tipo", "Tipo2", "Empresa", "Fecha de revision", "Mes",
+    "PSP_TIN", "PSP_TIN concatenado", "Estado", "Public ID",
+    "inv_id concatenado", "PEN", "Monto voucher", "Monto Kashio",
+    "Balance", "CANAL", "Banco", "Nro OP", "VOUCHER_FECHA"
+]
+
+# columna de la tabla -> (campo del archivo bancario, valor si el TIN no está en el archivo)
+COLUMNAS_TXT = {
+    "Banco": ("VOUCHER_PSP", "COMPLETAR_BANCO"),
+    "Nro OP": ("VOUCHER_Operacion_PSP", "COMPLETAR_OPERACION"),
+    "VOUCHER_FECHA": ("VOUCHER_FECHA", "COMPLETAR_FECHA"),
+}
+
+
+_COLUMNAS_API = ["PSP_TIN", "_status", "Empresa", "Estado", "Public ID", "PEN", "Monto voucher", "Monto Kashio"]
+
+
+def _columnas_api(resultados_api):
+    import pandas as pd
+
+    # Una sola pasada sobre las respuestas JSON hacia tuplas planas; pandas arma las columnas en C.
+    filas = []
+    agregar = filas.append
+    for res in resultados_api:
+        d = res["data"]
+        if not d:
+            agregar((res["tin"], None, "ERROR EN CONSULTA", f"Error HTTP {res.get('error')}", None, "N/A", 0.0, 0.0))
+            continue
+        act_list = d.get("activity_list", [])
+        sub_total, total = d.get("sub_total"), d.get("total")
+        agregar((
+            res["tin"], d.get("status"),
+            (d.get("creditor") or {}).get("name", "N/A"),
+            act_list[0].get("name", "N/A") if (isinstance(act_list, list) and act_list) else "N/A",
+            d.get("public_id", "N/A"),
+            (sub_total or {}).get("currency", "N/A"),
+            sub_total.get("value", 0.0) if sub_total else 0.0,
+            total.get("value", 0.0) if total else 0.0,
+        ))
+    df = pd.DataFrame.from_records(filas, columns=_COLUMNAS_API, coerce_float=True)
+    df["Monto voucher"] = df["Monto voucher"].astype(float)
+    df["Monto Kashio"] = df["Monto Kashio"].astype(float)
+    return df
+
+
+def _frame_txt(datos_txt, tins):
+    import pandas as pd
+
+    # Solo los TIN consultados: el índice del archivo puede tener millones de registros.
+    if isinstance(datos_txt, IndiceTins):
+        return datos_txt.to_frame(tins)
+    encontrados = [t for t in tins if t in datos_txt]
+    registros = [datos_txt[t] for t in encontrados]
+    return pd.DataFrame(
+        {campo: [r[campo] for r in registros] for campo, _ in COLUMNAS_TXT.values()},
+        index=pd.Index(encontrados, dtype=object),
+    )
+
+
+def consolidar_datos_tabla(resultados_api, datos_txt):
+    with tramo("consolidar_datos_tabla", filas=len(resultados_api)):
+        return _consolidar_datos_tabla(resultados_api, datos_txt)
+
+
+def _consolidar_datos_tabla(resultados_api, datos_txt):
+    ahora = datetime.now()
+    df = _columnas_api(resultados_api)
+
+    # Unión por clave TIN (reindex = left join sobre el índice del archivo bancario).
+    txt = _frame_txt(datos_txt, [res["tin"] for res in resultados_api]).reindex(df["PSP_TIN"])
+    for col, (campo, faltante) in COLUMNAS_TXT.items():
+        df[col] = txt[campo].fillna(faltante).to_numpy()
+
+    df["Tipo"], df["Tipo2"], df["CANAL"] = "Reg.Interna", "EECC", "WEB"
+    df["Fecha de revision"] = f"{ahora.month}/{ahora.day}/{ahora.year}"
+    df["Mes"] = ahora.strftime("%B")
+    df["PSP_TIN concatenado"] = "'" + df["PSP_TIN"] + "',"
+    con_id = df["Public ID"].notna()
+    df["inv_id concatenado"] = ("'" + df["Public ID"].astype(str) + "',").where(con_id, "N/A")
+    df["Public ID"] = df["Public ID"].where(con_id, "N/A")
+    df["Balance"] = df["Monto Kashio"] - df["Monto voucher"]
+
+    pagados = df.loc[df["_status"] == "PAID", "PSP_TIN"].tolist()
+    return df[COLUMN_ORDER], pagados
+
+
+def tins_a_reconsultar(resultados, tins=(), marcados=()):
+    # resultados: {tin: respuesta}. Fallidos + ``tins`` aún no consultados + ``marcados``, sin repetir.
+    fallidos = [t for t, r in resultados.items() if not r["data"]]
+    nuevos = [t for t in tins if t not in resultados]
+    return list(dict.fromkeys([*fallidos, *nuevos, *marcados]))
+
+
+def aplicar_ediciones_pagina(df, etiquetas, ediciones):
+    """Aplica sobre ``df`` el estado de un ``st.data_editor`` que mostraba las filas ``etiquetas``.
+
+    Las celdas editadas se escriben en el lugar, por etiqueta de fila (sin copiar la
+    tabla). Solo si hubo filas borradas o agregadas se arma un DataFrame nuevo.
+    Devuelve ``(df, cambio_filas)``.
+    """
+    import pandas as pd
+
+    if not ediciones:
+        return df, False
+    for fila, cambios in (ediciones.get("edited_rows") or {}).items():
+        etiqueta = etiquetas[int(fila)]
+        for col, valor in cambios.items():
+            df.at[etiqueta, col] = valor
+    borradas = [etiquetas[int(fila)] for fila in ediciones.get("deleted_rows") or []]
+    agregadas = [f for f in ediciones.get("added_rows") or [] if f]
+    if not borradas and not agregadas:
+        return df, False
+    if borradas:
+        df = df.drop(borradas)
+    if agregadas:
+        df = pd.concat([df, pd.DataFrame(agregadas, columns=df.columns)])
+    return df.reset_index(drop=True), True
+
+
+FILTROS_TABLA = ("Todas", "Solo alertas", "Solo PAID", "Solo errores")
+
+
+def filas_filtradas(df, filtro, mascaras=None, pagados=(), con_error=()):
+    """Etiquetas de las filas de ``df`` que pasan ``filtro`` (uno de FILTROS_TABLA).
+
+    ``mascaras`` son las de ``mascaras_alerta(df)``; ``pagados`` y ``con_error`` listas de PSP_TIN.
+    """
+    import numpy as np
+
+    if filtro == "Solo alertas":
+        m = np.zeros(len(df), dtype=bool)
+        for mascara in (mascaras or {}).values():
+            m |= mascara.to_numpy()
+    elif filtro == "Solo PAID":
+        m = df["PSP_TIN"].isin(pagados).to_numpy()
+    elif filtro == "Solo errores":
+        m = df["PSP_TIN"].isin(con_error).to_numpy()
+    else:
+        return df.index
+    return df.index[m]
+
+
+def actualizar_conciliacion(df, resultados_api, datos_txt):
+    """Recalcula solo las filas de ``resultados_api`` y las parcha en ``df`` por PSP_TIN.
+
+    Las filas de TIN que no estaban en ``df`` se agregan al final. Devuelve
+    ``(df, pagados)`` con los PAID entre los TIN recalculados.
+    """
+    import pandas as pd
+
+    parche, pagados = consolidar_datos_tabla(resultados_api, datos_txt)
+    with tramo("actualizar_conciliacion", filas=len(df), parche=len(parche)):
+        posiciones = pd.Series(df.index, index=df["PSP_TIN"].astype(str))
+        posiciones = posiciones[~posiciones.index.duplicated(keep="last")]
+        existe = parche["PSP_TIN"].isin(posiciones.index).to_numpy()
+        filas = posiciones.loc[parche.loc[existe, "PSP_TIN"]].to_numpy()
+        df = df.copy()
+        for col in COLUMN_ORDER:
+            df.loc[filas, col] = parche.loc[existe, col].to_numpy()
+        if not existe.all():
+            df = pd.concat([df, parche.loc[~existe]], ignore_index=True)
+    return df, pagados
+
+
+# ==========================================
+# Alertas
+# ==========================================
+ALERTA = 'background-color: #ffe6e6; color: #cc0000; font-weight: bold;'
+
+# (columna, operador, umbral, aviso). Las filas que cumplen alguna regla de un mismo aviso
+# se cuentan una sola vez en "Revisar antes de ejecutar". Valores no numéricos no alertan.
+REGLAS_ALERTA = [
+    ("Balance", "abs>", 5, "Balance mayor a {umbral}"),
+    ("Monto voucher", ">=", 500, "Monto voucher o Monto Kashio mayor o igual a {umbral}"),
+    ("Monto Kashio", ">=", 500, "Monto voucher o Monto Kashio mayor o igual a {umbral}"),
+]
+
+_OPERADORES = {
+    ">": lambda s, u: s > u,
+    ">=": lambda s, u: s >= u,
+    "abs>": lambda s, u: s.abs() > u,
+    "abs>=": lambda s, u: s.abs() >= u,
+}
+
+
+def mascaras_alerta(df, reglas=REGLAS_ALERTA):
+    """Máscara booleana por columna con alerta, calculada por columna (sin recorrer filas)."""
+    import pandas as pd
+
+    mascaras = {}
+    with tramo("mascaras_alerta", filas=len(df)):
+        for col, op, umbral, _ in reglas:
+            if col not in df.columns:
+                continue
+            m = _OPERADORES[op](pd.to_numeric(df[col], errors="coerce"), umbral).fillna(False).astype(bool)
+            mascaras[col] = (mascaras[col] | m) if col in mascaras else m
+    return mascaras
+
+
+def conteo_alertas(df, mascaras, reglas=REGLAS_ALERTA):
+    # {aviso: filas con alerta}, en el orden de las reglas.
+    por_aviso = {}
+    for col, _, umbral, aviso in reglas:
+        if col not in mascaras:
+            continue
+        texto = aviso.format(umbral=umbral)
+        por_aviso[texto] = (por_aviso[texto] | mascaras[col]) if texto in por_aviso else mascaras[col]
+    return {texto: int(m.sum()) for texto, m in por_aviso.items()}
+
+
+def estilos_alerta(df, mascaras):
+    # Para Styler.apply(..., axis=None): DataFrame de CSS con la forma de df.
+    import pandas as pd
+
+    with tramo("estilos_alerta", filas=len(df)):
+        estilos = pd.DataFrame('', index=df.index, columns=df.columns)
+        for col, m in mascaras.items():
+            estilos[col] = m.map({True: ALERTA, False: ''}).to_numpy()
+    return estilos
+
+
+def huella_df(df, columnas=None):
+    # Hash de contenido para cachear resultados derivados de una versión del DataFrame.
+    import pandas as pd
+
+    sub = df if columnas is None else df[[c for c in columnas if c in df.columns]]
+    return f"{len(sub)}:{int(pd.util.hash_pandas_object(sub, index=True).sum())}:{','.join(map(str, sub.columns))}"
+
+
+# ==========================================
+# Exportación
+# ==========================================
+# formato -> (extensión, MIME)
+FORMATOS_EXPORTACION = {
+    "xlsx": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("csv", "text/csv"),
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+# A partir de estas filas la UI propone CSV en lugar de Excel.
+FILAS_EXPORTACION_LIVIANA = 20000
+
+
+def _escribir_xlsx(df, buffer, hoja):
+    # Escritura en streaming fila a fila: xlsxwriter en constant_memory si está instalado
+    # (~2x más rápido), si no openpyxl en modo write-only. Ninguno arma objetos Cell.
+    filas = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    encabezado = [str(c) for c in df.columns]
+    try:
+        import xlsxwriter
+    except ImportError:
+        from openpyxl import Workbook
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(hoja)
+        ws.append(encabezado)
+        for fila in filas:
+            ws.append(fila)
+        wb.save(buffer)
+        return
+    wb = xlsxwriter.Workbook(buffer, {"constant_memory": True, "in_memory": False,
+                                      "strings_to_formulas": False, "strings_to_urls": False})
+    ws = wb.add_worksheet(hoja)
+    ws.write_row(0, 0, encabezado)
+    for i, fila in enumerate(filas, 1):
+        ws.write_row(i, 0, fila)
+    wb.close()
+
+
+def exportar_reporte(df, formato="xlsx", hoja="Conciliacion"):
+    """Serializa la tabla de conciliación a bytes en el formato indicado."""
+    from io import BytesIO
+
+    buffer = BytesIO()
+    with tramo("exportar_reporte", formato=formato, filas=len(df)) as t:
+        if formato == "xlsx":
+            _escribir_xlsx(df, buffer, hoja)
+        elif formato == "csv":
+            buffer.write(df.to_csv(index=False).encode("utf-8-sig"))
+        elif formato == "parquet":
+            # Columnas editadas a mano pueden mezclar tipos: esas se guardan como texto.
+            mixtas = {c: "string" for c in df.columns if df[c].dtype == object and df[c].map(type).nunique() > 1}
+            df.astype(mixtas).to_parquet(buffer, index=False)
+        else:
+            raise ValueError(f"Formato de exportación no soportado: {formato}")
+        t["bytes"] = buffer.tell()
+    return buffer.getvalue()
+
+
+# ==========================================
+# Trama de pagos
+# ==========================================
+# columna de la tabla -> campo de la trama que consume ejecutar_post_pagos
+CAMPOS_TRAMA = {
+    "Banco": "VOUCHER_PSP",
+    "PSP_TIN": "VOUCHER_PSP_TIN",
+    "PEN": "VOUCHER_Currency",
+    "Monto voucher": "VOUCHER_Amount",
+    "Nro OP": "VOUCHER_Operacion_PSP",
+    "VOUCHER_FECHA": "VOUCHER_FECHA",
+}
+
+
+def _json_loads(texto):
+    return orjson.loads(texto) if orjson else json.loads(texto)
+
+
+def _json_dumps(obj):
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj, ensure_ascii=False)
+
+
+def _validar_registro(reg):
+    if not isinstance(reg, dict):
+        return "se esperaba un objeto {...}"
+    faltantes = [c for c in CAMPOS_TRAMA.values() if c not in reg]
+    if faltantes:
+        return f"faltan campos: {', '.join(faltantes)}"
+    monto = reg["VOUCHER_Amount"]
+    if isinstance(monto, bool) or not isinstance(monto, (int, float)) or not math.isfinite(monto):
+        return f"VOUCHER_Amount no numérico: {monto!r}"
+    return None
+
+
+def validar_payload(registros):
+    """Separa registros válidos de los inválidos: ``(validos, [(nro_linea, mensaje), ...])``."""
+    validos, errores = [], []
+    for nro, reg in enumerate(registros, 1):
+        error = _validar_registro(reg)
+        if error:
+            errores.append((nro, error))
+        else:
+            validos.append(reg)
+    return validos, errores
+
+
+def construir_payload(df):
+    # Registros de la trama tomados directamente de las columnas, sin pasar por texto.
+    import pandas as pd
+
+    if df is None or df.empty:
+        return []
+    sub = df[list(CAMPOS_TRAMA)].rename(columns=CAMPOS_TRAMA)
+    textos = [c for c in sub.columns if c != "VOUCHER_Amount"]
+    sub[textos] = sub[textos].astype(str)
+    sub["VOUCHER_Amount"] = pd.to_numeric(sub["VOUCHER_Amount"], errors="coerce")
+    return sub.to_dict("records")
+
+
+def trama_desde_payload(registros):
+    # Texto de la caja de edición manual: un objeto JSON por línea (NDJSON).
+    return "\n".join(_json_dumps(reg) for reg in registros)
+
+
+def _parsear_valor(texto):
+    try:
+        return _json_loads(texto)
+    except ValueError:
+        return ast.literal_eval(texto)  # formato anterior: {'VOUCHER_PSP':'BCP',...},
+
+
+def parsear_trama(texto):
+    """Interpreta la trama manual: arreglo JSON, NDJSON o el formato literal anterior.
+
+    Devuelve ``(registros_validos, errores)`` con errores por número de línea.
+    """
+    clean = texto.strip()
+    if not clean:
+        return [], []
+    if clean.startswith("["):
+        try:
+            registros = _parsear_valor(clean)
+        except (ValueError, SyntaxError) as e:
+            return [], [(1, f"estructura inválida: {e}")]
+        return validar_payload(registros if isinstance(registros, list) else [registros])
+    validos, errores = [], []
+    for nro, linea in enumerate(texto.splitlines(), 1):
+        linea = linea.strip().rstrip(",")
+        if not linea:
+            continue
+        try:
+            reg = _parsear_valor(linea)
+        except (ValueError, SyntaxError) as e:
+            errores.append((nro, f"no es JSON válido: {e}"))
+            continue
+        error = _validar_registro(reg)
+        if error:
+            errores.append((nro, error))
+        else:
+            validos.append(reg)
+    return validos, errores
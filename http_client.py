@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Sesión HTTP compartida por engine y logic_processor.
+
+``SesionResiliente`` es un ``requests.Session`` que, por host de destino:
+  - limita la tasa con un balde de tokens (compartido entre sesiones e hilos),
+  - corta rápido con un disyuntor tras varios 429/5xx o errores de red seguidos,
+  - reintenta 429/503 (y 502/504/errores de red si la llamada es idempotente)
+    respetando Retry-After.
+Así se puede subir la concurrencia sin que un backend degradado alargue la corrida.
+"""
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+
+from telemetry import sumar
+
+# Tasa máxima por host (requests/s) y ráfaga permitida. Por encima de lo que alcanzan
+# MAX_CONSULTAS_SIMULTANEAS hilos con latencias normales: solo frena picos y reintentos.
+TASA_POR_HOST = float(os.environ.get("KASHIO_TASA_POR_HOST", 250))
+RAFAGA_POR_HOST = int(os.environ.get("KASHIO_RAFAGA_POR_HOST", 50))
+# Disyuntor: fallos seguidos para abrir y segundos abierto antes de probar de nuevo.
+UMBRAL_DISYUNTOR = 8
+ENFRIAMIENTO_DISYUNTOR = 30.0
+# Reintentos: cantidad, backoff base (s) y espera máxima aceptada de Retry-After (s).
+MAX_REINTENTOS = 3
+ESPERA_BASE = 0.5
+ESPERA_MAX = 30.0
+TIMEOUT_CONEXION = 5
+
+_STATUS_REINTENTABLE = {429, 503}                # el servidor no procesó la llamada
+_STATUS_REINTENTABLE_IDEMPOTENTE = {502, 504}    # puede haberla procesado
+_STATUS_FALLO = {429, 500, 502, 503, 504}
+
+
+class CircuitoAbierto(requests.exceptions.RequestException):
+    """El host acumuló demasiados fallos seguidos; se rechaza sin llamar."""
+
+
+class LimitadorTokens:
+    def __init__(self, tasa, rafaga):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self._tokens = float(rafaga)
+        self._ultimo = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._lock = threading.Lock()
+
+    def adquirir(self):
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._tokens = min(self.rafaga, self._tokens + (ahora - self._ultimo) * self.tasa)
+                self._ultimo = ahora
+                espera = self._pausa_hasta - ahora
+                if espera <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    espera = (1 - self._tokens) / self.tasa
+            time.sleep(espera)
+
+    def pausar(self, segundos):
+        # Un 429 con Retry-After frena a todos los hilos que usan el host, no solo al que lo recibió.
+        with self._lock:
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+
+
+class Disyuntor:
+    def __init__(self, umbral=UMBRAL_DISYUNTOR, enfriamiento=ENFRIAMIENTO_DISYUNTOR):
+        self.umbral = umbral
+        self.enfriamiento = enfriamiento
+        self.fallos = 0
+        self._abierto_hasta = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    def permitir(self, host):
+        with self._lock:
+            if self.fallos < self.umbral:
+                return
+            restante = self._abierto_hasta - time.monotonic()
+            if restante > 0 or self._prueba_en_curso:
+                raise CircuitoAbierto(f"Circuito abierto para {host} tras {self.fallos} fallos seguidos; "
+                                      f"reintentar en {max(restante, 0):.0f}s")
+            self._prueba_en_curso = True  # semiabierto: pasa una sola llamada de prueba
+
+    def registrar(self, exito):
+        with self._lock:
+            self._prueba_en_curso = False
+            if exito is None:  # error local (URL, cuerpo): no dice nada del host
+                return
+            if exito:
+                self.fallos = 0
+            else:
+                self.fallos += 1
+                if self.fallos >= self.umbral:
+                    self._abierto_hasta = time.monotonic() + self.enfriamiento
+
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def estado_host(host):
+    """(limitador, disyuntor) del host, compartidos por todas las sesiones del proceso."""
+    with _hosts_lock:
+        if host not in _hosts:
+            _hosts[host] = (LimitadorTokens(TASA_POR_HOST, RAFAGA_POR_HOST), Disyuntor())
+        return _hosts[host]
+
+
+def _espera_retry_after(resp, intento):
+    valor = resp.headers.get("Retry-After") if resp is not None else None
+    if valor:
+        try:
+            return min(float(valor), ESPERA_MAX)
+        except ValueError:
+            try:
+                return min(max(parsedate_to_datetime(valor).timestamp() - time.time(), 0), ESPERA_MAX)
+            except (TypeError, ValueError):
+                pass
+    return min(ESPERA_BASE * 2 ** intento, ESPERA_MAX) * random.uniform(0.5, 1.0)
+
+
+class SesionResiliente(requests.Session):
+    """requests.Session con límite de tasa, disyuntor y reintentos por host.
+
+    ``idempotente`` (kwarg de request/get/post) indica si repetir la llamada es seguro
+    ante 502/504 o errores de red; por defecto solo GET/HEAD. Una cabecera
+    Idempotency-Key no basta: no consta que el backend deduplique por ella. Los cuerpos
+    en streaming (con ``read``) nunca se reintentan.
+    """
+
+    def __init__(self, max_reintentos=MAX_REINTENTOS):
+        super().__init__()
+        self.max_reintentos = max_reintentos
+
+    def request(self, method, url, *args, idempotente=None, **kwargs):
+        host = urlsplit(url).netloc
+        limitador, disyuntor = estado_host(host)
+        if idempotente is None:
+            idempotente = method.upper() in ("GET", "HEAD")
+        if isinstance(kwargs.get("timeout"), (int, float)):
+            kwargs["timeout"] = (min(TIMEOUT_CONEXION, kwargs["timeout"]), kwargs["timeout"])
+        reintentos = 0 if hasattr(kwargs.get("data"), "read") else self.max_reintentos
+
+        for intento in range(reintentos + 1):
+            disyuntor.permitir(host)
+            limitador.adquirir()
+            try:
+                resp = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                disyuntor.registrar(False)
+                if not idempotente or intento == reintentos:
+                    raise
+                resp = None
+            except Exception:
+                disyuntor.registrar(None)
+                raise
+            else:
+                disyuntor.registrar(resp.status_code not in _STATUS_FALLO)
+                reintentable = resp.status_code in _STATUS_REINTENTABLE or (
+                    idempotente and resp.status_code in _STATUS_REINTENTABLE_IDEMPOTENTE)
+                if not reintentable or intento == reintentos:
+                    return resp
+            espera = _espera_retry_after(resp, intento)
+            if resp is not None and resp.status_code == 429:
+                limitador.pausar(espera)
+            sumar(reintentos=1)
+            time.sleep(espera)
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""Cola local de trabajos en segundo plano: consulta de TIN, pagos y cargas EDT.
+
+Los trabajos corren en hilos del proceso; estado, avance, eventos y resultados
+parciales se guardan en SQLite. Un rerun o recarga de Streamlit no los detiene y la
+UI solo sondea su estado. Cada trabajo avanza por tandas y guarda lo hecho, así que
+``cancelar`` se atiende entre tandas y ``reanudar`` continúa desde lo guardado
+(también tras reiniciar el proceso: quedan como ``interrumpido``).
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from telemetry import RegistroTramos, usar_registro
+
+JOBS_SQLITE = os.environ.get("KASHIO_JOBS", "jobs.sqlite3")
+JOBS_DIR = os.environ.get("KASHIO_JOBS_DIR", "jobs_archivos")  # archivos EDT de los trabajos de carga
+MAX_TRABAJOS_SIMULTANEOS = 4
+TANDA_CONSULTA = 200
+TANDA_PAGOS = 50
+INTERVALO_AVANCE = 0.5  # s entre escrituras de avance
+
+ESTADOS_ACTIVOS = ("pendiente", "ejecutando", "cancelando")
+ESTADOS_REANUDABLES = ("cancelado", "error", "interrumpido")
+
+
+class TrabajoCancelado(Exception):
+    pass
+
+
+class ContextoTrabajo:
+    """Lo que ve la función de un trabajo: avance, eventos, cancelación y parciales."""
+
+    def __init__(self, cola, job_id):
+        self.cola = cola
+        self.job_id = job_id
+        self._ultimo_avance = -INTERVALO_AVANCE  # la primera escritura (con el total) nunca se salta
+        self._ultimo_chequeo = 0.0
+        self._cancelado = False
+
+    def progreso(self, hechos, total):
+        ahora = time.monotonic()
+        if hechos < total and ahora - self._ultimo_avance < INTERVALO_AVANCE:
+            return
+        self._ultimo_avance = ahora
+        with self.cola._sqlite() as con:
+            con.execute("UPDATE trabajos SET hechos = ?, total = ?, actualizado = ? WHERE id = ?",
+                        (hechos, total, time.time(), self.job_id))
+
+    def log(self, mensaje):
+        with self.cola._sqlite() as con:
+            con.execute("INSERT INTO eventos (job_id, fecha, mensaje) VALUES (?, ?, ?)", (self.job_id, time.time(), mensaje))
+
+    def cancelado(self):
+        ahora = time.monotonic()
+        if not self._cancelado and ahora - self._ultimo_chequeo >= INTERVALO_AVANCE:
+            self._ultimo_chequeo = ahora
+            self._cancelado = self.cola.estado(self.job_id)["estado"] == "cancelando"
+        return self._cancelado
+
+    def verificar(self):
+        if self.cancelado():
+            raise TrabajoCancelado()
+
+    def parciales(self):
+        return self.cola.parciales(self.job_id)
+
+    def guardar(self, pares):
+        # El avance se iguala a lo guardado sin esperar al intervalo: es lo que ``reanudar`` no repite.
+        with self.cola._sqlite() as con:
+            con.executemany("INSERT OR REPLACE INTO parciales (job_id, clave, valor) VALUES (?, ?, ?)",
+                            [(self.job_id, clave, json.dumps(valor, default=str)) for clave, valor in pares])
+            _avance_guardado(con, self.job_id)
+
+
+# ==========================================
+# Tipos de trabajo
+# ==========================================
+def _trabajo_consulta(ctx, p):
+    # p: {"tins": [...], "forzar": bool}. Parciales: tin -> respuesta.
+    import engine
+
+    tins, hechos = p["tins"], ctx.parciales()
+    ctx.progreso(len(hechos), len(tins))
+    pendientes = [t for t in tins if t not in hechos]
+    for i in range(0, len(pendientes), TANDA_CONSULTA):
+        ctx.verificar()
+        base = len(hechos)
+        res = engine.consultar_api_tins(pendientes[i:i + TANDA_CONSULTA], cache=ctx.cola.cache_consultas,
+                                        forzar=p.get("forzar", False), progreso=lambda h, _: ctx.progreso(base + h, len(tins)))
+        ctx.guardar((r["tin"], r) for r in res)
+        hechos.update((r["tin"], r) for r in res)
+    return {"tins": len(tins), "errores": sum(1 for r in hechos.values() if not r["data"])}
+
+
+def _trabajo_pagos(ctx, p):
+    # p: {"payload": [...], "usuario": str, "desde_cache": [tin, ...], "pagados": [tin, ...]}.
+    # Parciales: posición en el payload -> fila de resultado.
+    # Antes de cada tanda se reconsultan los TIN que la consulta sirvió desde cache; ningún TIN
+    # que figure PAID se envía. Reanudar es seguro: el ledger de pagos marca YA_PAGADO lo confirmado antes.
+    import engine
+
+    payload, hechos = p["payload"], ctx.parciales()
+    desde_cache, pagados = set(p.get("desde_cache", ())), set(p.get("pagados", ()))
+    ctx.progreso(len(hechos), len(payload))
+    pendientes = [i for i in range(len(payload)) if str(i) not in hechos]
+    for k in range(0, len(pendientes), TANDA_PAGOS):
+        ctx.verificar()
+        tanda = pendientes[k:k + TANDA_PAGOS]
+        refrescar = list(dict.fromkeys(t for t in (payload[i].get('VOUCHER_PSP_TIN') for i in tanda) if t in desde_cache))
+        if refrescar:
+            frescos = engine.consultar_api_tins(refrescar, cache=ctx.cola.cache_consultas, forzar=True)
+            pagados = (pagados - set(refrescar)) | set(engine.tins_pagados(frescos))
+            desde_cache -= set(refrescar)
+        omitir = [i for i in tanda if payload[i].get('VOUCHER_PSP_TIN') in pagados]
+        if omitir:
+            ctx.log(f"Se omiten {len(omitir)} operación(es) que ya figuran como PAID")
+        enviar = [i for i in tanda if i not in set(omitir)]
+        base = len(hechos)
+        df = engine.ejecutar_post_pagos([payload[i] for i in enviar], p["usuario"],
+                                        progreso=lambda h, _: ctx.progreso(base + h, len(payload)))
+        filas = [(str(i), engine.fila_pagado(payload[i].get('VOUCHER_PSP_TIN'))) for i in omitir]
+        filas += [(str(i), fila) for i, fila in zip(enviar, df.to_dict("records"))]
+        ctx.guardar(filas)
+        hechos.update(filas)
+    return {"registros": len(payload), "ok": sum(1 for f in hechos.values() if f["STATUS"] == 200)}
+
+
+def _trabajo_carga(ctx, p):
+    # p: {"archivos": [[filename, ruta, flow_key], ...]}. Parciales: posición en archivos -> resultado del flujo
+    # (dos archivos pueden llamarse igual).
+    import logic_processor
+
+    archivos, hechos = p["archivos"], ctx.parciales()
+    ctx.progreso(len(hechos), len(archivos))
+    pendientes = [i for i in range(len(archivos)) if str(i) not in hechos]
+    for ev in logic_processor.orquestar_cargas([archivos[i] for i in pendientes], cancelado=ctx.cancelado):
+        if ev["tipo"] == "log":
+            ctx.log(f"[{ev['archivo']}] {ev['mensaje']}")
+        elif ev["resultado"]["status"] != logic_processor.CANCELADO:  # los cancelados quedan para reanudar
+            fila = [(str(pendientes[ev["indice"]]), ev["resultado"])]
+            ctx.guardar(fila)
+            hechos.update(fila)
+    ctx.verificar()
+    for _, ruta, _ in archivos:  # copias de ColaTrabajos.archivar; solo hacían falta para reanudar
+        if os.path.dirname(os.path.abspath(ruta)) == os.path.abspath(ctx.cola.directorio) and os.path.exists(ruta):
+            os.remove(ruta)
+    return {"archivos": len(archivos), "exitosos": sum(1 for r in hechos.values() if r["status"].startswith("✅"))}
+
+
+TIPOS_TRABAJO = {"consulta": _trabajo_consulta, "pagos": _trabajo_pagos, "carga": _trabajo_carga}
+
+
+# ==========================================
+# Cola
+# ==========================================
+class ColaTrabajos:
+    """Cola compartida por todas las sesiones del proceso (crear una sola instancia).
+
+    ``max_trabajos`` trabajos corren a la vez, de cualquier operador; el resto espera
+    como ``pendiente``.
+    """
+
+    def __init__(self, ruta_sqlite=JOBS_SQLITE, max_trabajos=MAX_TRABAJOS_SIMULTANEOS, directorio=JOBS_DIR,
+                 cache_consultas=None):
+        self.ruta_sqlite = ruta_sqlite
+        self.directorio = directorio
+        self.cache_consultas = cache_consultas
+        self._pool = ThreadPoolExecutor(max_workers=max_trabajos, thread_name_prefix="trabajo")
+        self._lock = threading.Lock()
+        with self._sqlite() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("CREATE TABLE IF NOT EXISTS trabajos (id TEXT PRIMARY KEY, tipo TEXT, propietario TEXT, "
+                        "estado TEXT, creado REAL, actualizado REAL, hechos INTEGER, total INTEGER, "
+                        "mensaje TEXT, parametros TEXT, resumen TEXT)")
+            con.execute("CREATE TABLE IF NOT EXISTS eventos (seq INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT, "
+                        "fecha REAL, mensaje TEXT)")
+            con.execute("CREATE TABLE IF NOT EXISTS parciales (job_id TEXT, clave TEXT, valor TEXT, "
+                        "PRIMARY KEY (job_id, clave))")
+            # Lo que estaba activo al morir el proceso anterior ya no corre.
+            con.execute(f"UPDATE trabajos SET estado = 'interrumpido' WHERE estado IN ({','.join('?' * len(ESTADOS_ACTIVOS))})",
+                        ESTADOS_ACTIVOS)
+
+    def _sqlite(self):
+        return sqlite3.connect(self.ruta_sqlite, timeout=30)
+
+    def archivar(self, nombre, contenido):
+        """Guarda el contenido de un archivo subido para un trabajo de carga y devuelve la ruta."""
+        os.makedirs(self.directorio, exist_ok=True)
+        ruta = os.path.join(self.directorio, f"{uuid.uuid4().hex}_{os.path.basename(nombre)}")
+        with open(ruta, "wb") as f:
+            f.write(contenido)
+        return ruta
+
+    def enviar(self, tipo, parametros, propietario=""):
+        if tipo not in TIPOS_TRABAJO:
+            raise ValueError(f"Tipo de trabajo desconocido: {tipo}")
+        job_id = uuid.uuid4().hex[:12]
+        ahora = time.time()
+        with self._sqlite() as con:
+            con.execute("INSERT INTO trabajos VALUES (?, ?, ?, 'pendiente', ?, ?, 0, 0, '', ?, NULL)",
+                        (job_id, tipo, propietario, ahora, ahora, json.dumps(parametros, default=str)))
+        self._pool.submit(self._ejecutar, job_id)
+        return job_id
+
+    def _cambiar_estado(self, job_id, estado, desde=None, mensaje=None, resumen=None):
+        # Con ``desde`` solo cambia si el estado actual es uno de esos (transición atómica).
+        sql = "UPDATE trabajos SET estado = ?, actualizado = ?"
+        args = [estado, time.time()]
+        if mensaje is not None:
+            sql += ", mensaje = ?"
+            args.append(mensaje)
+        if resumen is not None:
+            sql += ", resumen = ?"
+            args.append(json.dumps(resumen, default=str))
+        sql += " WHERE id = ?"
+        args.append(job_id)
+        if desde:
+            sql += f" AND estado IN ({','.join('?' * len(desde))})"
+            args.extend(desde)
+        with self._lock, self._sqlite() as con:
+            return con.execute(sql, args).rowcount > 0
+
+    def _ejecutar(self, job_id):
+        if not self._cambiar_estado(job_id, "ejecutando", desde=("pendiente",)):
+            return  # cancelado antes de empezar
+        fila = self.estado(job_id)
+        ctx = ContextoTrabajo(self, job_id)
+        registro = RegistroTramos()
+        try:
+            with usar_registro(registro):
+                resumen = TIPOS_TRABAJO[fila["tipo"]](ctx, fila["parametros"])
+            resumen["tramos"] = registro.tramos()  # la UI los suma a los tiempos de la sesión
+            self._cambiar_estado(job_id, "terminado", mensaje="", resumen=resumen)
+        except TrabajoCancelado:
+            self._cambiar_estado(job_id, "cancelado", mensaje="Cancelado por el operador")
+        except Exception as e:
+            self._cambiar_estado(job_id, "error", mensaje=f"{type(e).__name__}: {e}")
+        else:
+            return
+        # El último avance escrito pudo quedar atrasado (o adelantado a una tanda sin guardar).
+        with self._sqlite() as con:
+            _avance_guardado(con, job_id)
+
+    def cancelar(self, job_id):
+        if not self._cambiar_estado(job_id, "cancelado", desde=("pendiente",), mensaje="Cancelado antes de iniciar"):
+            self._cambiar_estado(job_id, "cancelando", desde=("ejecutando",))
+
+    def reanudar(self, job_id):
+        if self._cambiar_estado(job_id, "pendiente", desde=ESTADOS_REANUDABLES, mensaje=""):
+            self._pool.submit(self._ejecutar, job_id)
+            return True
+        return False
+
+    def estado(self, job_id):
+        with self._sqlite() as con:
+            con.row_factory = sqlite3.Row
+            fila = con.execute("SELECT * FROM trabajos WHERE id = ?", (job_id,)).fetchone()
+        return _fila_trabajo(fila) if fila else None
+
+    def listar(self, propietario=None, limite=20):
+        sql, args = "SELECT * FROM trabajos", []
+        if propietario is not None:
+            sql += " WHERE propietario = ?"
+            args.append(propietario)
+        sql += " ORDER BY creado DESC LIMIT ?"
+        args.append(limite)
+        with self._sqlite() as con:
+            con.row_factory = sqlite3.Row
+            return [_fila_trabajo(f) for f in con.execute(sql, args)]
+
+    def activos(self, tipo):
+        """Trabajos de ``tipo`` que todavía no terminaron, de cualquier operador."""
+        with self._sqlite() as con:
+            con.row_factory = sqlite3.Row
+            filas = con.execute(f"SELECT * FROM trabajos WHERE tipo = ? AND estado IN ({', '.join('?' * len(ESTADOS_ACTIVOS))})",
+                                (tipo, *ESTADOS_ACTIVOS))
+            return [_fila_trabajo(f) for f in filas]
+
+    def eventos(self, job_id, desde=0):
+        """[(seq, mensaje)] posteriores a ``desde``."""
+        with self._sqlite() as con:
+            return con.execute("SELECT seq, mensaje FROM eventos WHERE job_id = ? AND seq > ? ORDER BY seq",
+                               (job_id, desde)).fetchall()
+
+    def parciales(self, job_id):
+        with self._sqlite() as con:
+            return {clave: json.loads(valor) for clave, valor in
+                    con.execute("SELECT clave, valor FROM parciales WHERE job_id = ?", (job_id,))}
+
+
+def _avance_guardado(con, job_id):
+    con.execute("UPDATE trabajos SET hechos = (SELECT COUNT(*) FROM parciales WHERE job_id = ?), actualizado = ? "
+                "WHERE id = ?", (job_id, time.time(), job_id))
+
+
+def _fila_trabajo(fila):
+    trabajo = dict(fila)
+    trabajo["parametros"] = json.loads(trabajo["parametros"] or "{}")
+    trabajo["resumen"] = json.loads(trabajo["resumen"]) if trabajo["resumen"] else None
+    return trabajo
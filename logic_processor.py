@@ -1,11 +1,28 @@
+import contextvars
+import os
+import queue
+import random
+import re
 import time
-import requests
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+
+from http_client import CircuitoAbierto, SesionResiliente
+from telemetry import sumar, tramo
 
 # --- CONFIGURACIÓN ---
-RECONCILE_RETRY_CONFIG = [
-    (20,  3), (40,  4), (50,  5), (60,  8), (float("inf"), 10),
-]
+# Sondeo adaptativo: espera inicial y máxima entre consultas (s), factor de backoff,
+# plazo base (s, + plazo_por_linea * líneas del archivo), extensión del plazo cada vez que
+# el servidor muestra avance y tope absoluto del plazo.
+POLL_CONFIG = {
+    "sincronizar": {"espera": 0.5, "espera_max": 8, "factor": 1.6, "plazo": 20, "plazo_por_linea": 0, "extension": 20, "plazo_max": 600},
+    "reconciliar": {"espera": 0.5, "espera_max": 5, "factor": 1.6, "plazo": 5, "plazo_por_linea": 0.1, "extension": 10, "plazo_max": 300},
+}
 
 ENDPOINTS = {
     "udep": {
@@ -35,24 +52,178 @@ RULES_UDEP = [
     ("sub_YK5GU0000024", ["2103093"], [])
 ]
 
-# --- HELPERS ---
-def get_reconcile_retries(line_count):
-    for max_lines, retries in RECONCILE_RETRY_CONFIG:
-        if line_count <= max_lines: return retries
-    return 4
+REGLAS_POR_FLUJO = {"udep": RULES_UDEP, "euro": RULES_EURO}
 
-def find_subscription_id(filename, rules_list):
-    fname_lower = filename.lower()
-    for sub_id, inc, exc in rules_list:
-        if any(i in fname_lower for i in inc) and not any(e in fname_lower for e in exc):
+# Flujos subir→procesar→sincronizar→reconciliar en paralelo. Como mucho uno activo por
+# (flujo, suscripción): procesar/sincronizar/reconciliar no identifican el archivo.
+MAX_FLUJOS_SIMULTANEOS = 4
+
+# Tamaño de bloque para leer/enviar archivos EDT sin tenerlos completos en memoria.
+CHUNK_SIZE = 256 * 1024
+
+# Timeout de lectura (s) por llamada: la subida puede tardar, los sondeos no.
+TIMEOUT_SUBIDA = 300
+TIMEOUT_LLAMADA = 30
+
+# --- ENRUTAMIENTO DE SUSCRIPCIONES ---
+def _patron_trie(terminos):
+    # Alternación con forma de trie ("rec(?:ibo)?" en vez de "rec|recibo"): en cada
+    # posición re avanza por un solo camino en lugar de probar todos los términos.
+    arbol = {}
+    for t in terminos:
+        nodo = arbol
+        for c in t:
+            nodo = nodo.setdefault(c, {})
+        nodo[""] = {}
+
+    def patron(nodo):
+        hijos = [re.escape(c) + patron(h) for c, h in sorted(nodo.items()) if c]
+        if not hijos:
+            return ""
+        alt = hijos[0] if len(hijos) == 1 and len(hijos[0]) == 1 else "(?:" + "|".join(hijos) + ")"
+        if "" not in nodo:
+            return hijos[0] if len(hijos) == 1 else alt
+        return alt + "?"
+
+    return patron(arbol)
+
+class EnrutadorSuscripciones:
+    """
+    Reglas [(sub_id, incluir, excluir)] compiladas una vez. Una sola búsqueda con regex
+    encuentra todos los términos presentes en el nombre (también los solapados y los que
+    son prefijo de otro); la primera regla, en orden, con algún término incluido y ningún
+    excluido gana, igual que el recorrido lineal. La resolución se memoriza por conjunto
+    de términos hallados.
+    """
+    MAX_MEMO = 4096
+
+    def __init__(self, reglas):
+        self.reglas = [(sub_id, frozenset(inc), frozenset(exc)) for sub_id, inc, exc in reglas]
+        terminos = {t for _, inc, exc in self.reglas for t in inc | exc}
+        # Con lookahead cada posición se prueba aunque un término anterior la cubra; la
+        # alternación del trie toma el término más largo y los más cortos que empiezan
+        # en la misma posición son sus prefijos.
+        self._regex = re.compile("(?=(" + _patron_trie(terminos) + "))") if terminos else None
+        self._prefijos = {t: frozenset(u for u in terminos if t.startswith(u)) for t in terminos}
+        self._memo = {}
+
+    def _resolver(self, hallados):
+        presentes = set().union(*(self._prefijos[t] for t in hallados))
+        for sub_id, inc, exc in self.reglas:
+            if not presentes.isdisjoint(inc) and presentes.isdisjoint(exc):
+                return sub_id
+        return None
+
+    def __call__(self, filename):
+        hallados = self._regex.findall(filename.lower()) if self._regex else None
+        if not hallados:
+            return None
+        clave = frozenset(hallados)
+        try:
+            return self._memo[clave]
+        except KeyError:
+            if len(self._memo) >= self.MAX_MEMO:
+                self._memo.clear()
+            sub_id = self._memo[clave] = self._resolver(clave)
             return sub_id
-    return None
 
-def validar_contenido(filename, content_str):
-    lines = content_str.splitlines()
-    count = len(lines)
+ENRUTADORES = {flow_key: EnrutadorSuscripciones(reglas) for flow_key, reglas in REGLAS_POR_FLUJO.items()}
+_enrutadores_por_lista = {}
+
+def find_subscription_id(filename, rules_list):
+    # El enrutador se compila una vez por lista de reglas (si se cambia una lista en
+    # caliente, reemplazarla por una nueva en vez de modificarla).
+    cacheado = _enrutadores_por_lista.get(id(rules_list))
+    if cacheado is None or cacheado[0] is not rules_list:
+        cacheado = _enrutadores_por_lista[id(rules_list)] = (rules_list, EnrutadorSuscripciones(rules_list))
+    return cacheado[1](filename)
+
+@contextmanager
+def abrir_archivo(fuente):
+    """
+    Entrega (archivo_binario, tamaño) para bytes, una ruta o un objeto archivo.
+    Para objetos archivo se respeta y luego se restaura la posición actual.
+    """
+    if isinstance(fuente, (bytes, bytearray, memoryview)):
+        yield BytesIO(fuente), len(fuente)
+    elif isinstance(fuente, (str, os.PathLike)):
+        with open(fuente, "rb") as f:
+            yield f, os.fstat(f.fileno()).st_size
+    else:
+        inicio = fuente.tell()
+        fuente.seek(0, os.SEEK_END)
+        tamano = fuente.tell() - inicio
+        fuente.seek(inicio)
+        try:
+            yield fuente, tamano
+        finally:
+            fuente.seek(inicio)
+
+class ContadorLineas:
+    # Cuenta líneas sobre bloques de bytes con el criterio de bytes.splitlines(): cortan
+    # \n, \r y \r\n (también si el \r\n queda partido entre dos bloques).
+    def __init__(self):
+        self.saltos = 0
+        self.ultimo = b""
+
+    def agregar(self, bloque, inicio=0, fin=None):
+        fin = len(bloque) if fin is None else min(fin, len(bloque))
+        if fin <= inicio:
+            return
+        self.saltos += bloque.count(b"\n", inicio, fin)
+        retornos = bloque.count(b"\r", inicio, fin)
+        if retornos:  # \r sueltos suman; los de \r\n ya se contaron con el \n
+            self.saltos += retornos - bloque.count(b"\r\n", inicio, fin)
+        if self.ultimo == b"\r" and bloque[inicio:inicio + 1] == b"\n":
+            self.saltos -= 1
+        self.ultimo = bytes(bloque[fin - 1:fin])
+
+    @property
+    def total(self):
+        return self.saltos + (1 if self.ultimo not in (b"", b"\n", b"\r") else 0)
+
+def _con_maximo(total, maximo):
+    return None if maximo is not None and total > maximo else total
+
+def contar_lineas(fuente, maximo=None):
+    """
+    Líneas de bytes, una ruta o un objeto archivo, leído por bloques.
+    Con ``maximo`` deja de leer en cuanto hay más de ``maximo`` líneas y devuelve None.
+    """
+    contador = ContadorLineas()
+    if isinstance(fuente, (bytes, bytearray)):
+        # count() en C sobre rangos del buffer, sin copiar ni partir (sin maximo, de una vez).
+        paso = CHUNK_SIZE if maximo is not None else max(len(fuente), 1)
+        for inicio in range(0, len(fuente), paso):
+            contador.agregar(fuente, inicio, inicio + paso)
+            if maximo is not None and contador.saltos > maximo:
+                return None
+        return _con_maximo(contador.total, maximo)
+    # Un solo buffer reutilizado: readinto no crea un bytes nuevo por bloque.
+    buffer = bytearray(CHUNK_SIZE)
+    with abrir_archivo(fuente) as (archivo, _):
+        while True:
+            n = archivo.readinto(buffer)
+            if not n:
+                break
+            contador.agregar(buffer, 0, n)
+            if maximo is not None and contador.saltos > maximo:
+                return None
+    return _con_maximo(contador.total, maximo)
+
+# Líneas que deciden los chequeos de "vacío"; más allá no hace falta leer antes de subir.
+LINEAS_VALIDACION = 2
+
+def validar_contenido(filename, content):
+    # content: texto (como antes), bytes, ruta (os.PathLike) u objeto archivo binario.
+    # Solo se lee hasta saber si el archivo está vacío: el conteo es None si tiene más de
+    # LINEAS_VALIDACION líneas, y api_upload_flow lo toma del que hace durante la subida.
+    if isinstance(content, str):
+        count = len(content.splitlines())
+    else:
+        count = contar_lineas(content, maximo=LINEAS_VALIDACION)
     base = filename.lower()
-    if (base.startswith("sbp") or base.startswith("bws")) and count <= 1:
+    if (base.startswith("sbp") or base.startswith("bws")) and count is not None and count <= 1:
         return False, "SBP/BWS Vacío", count
     if base.startswith("210309") and count == 0:
         return False, "210309 Vacío", count
@@ -73,80 +244,163 @@ def extraer_conteo_procesar(json_response):
 
 # --- BUCLES ROBUSTOS ---
 
-def loop_sincronizar_robusto(session, url, expected_count):
+def sondeo_adaptativo(consultar, config, line_count=0, sin_cambio_max=None):
     """
-    Intenta sincronizar esperando a que el servidor confirme la cantidad esperada.
+    Llama a consultar() con backoff exponencial + jitter hasta que indique fin.
+    consultar() devuelve (avance, terminado, resultado, texto_log). Mientras el avance
+    crezca el plazo se extiende, así un archivo grande no se corta si el servidor sigue
+    trabajando. Devuelve (terminado, ultimo_resultado, logs).
     """
     logs = []
-    
-    # Damos hasta 10 intentos (aprox 20 segundos)
-    for i in range(10):
+    inicio = time.monotonic()
+    plazo = min(config["plazo"] + line_count * config["plazo_por_linea"], config["plazo_max"])
+    espera = config["espera"]
+    mejor, previo, sin_cambio, resultado = -1, None, 0, None
+    i = 0
+    while True:
+        i += 1
+        t0 = time.monotonic()
+        sumar(requests=1)
         try:
-            r = session.post(url)
-            d = r.json()
-            if isinstance(d, list) and d: d = d[0]
-            
-            p = d.get("processed_record", 0)
-            f = d.get("failed_record", 0)
-            
-            logs.append(f"   🔹 [SINCR #{i+1}] Proc: {p} | Fail: {f}")
-            
-            # Si la suma de procesados + fallidos es igual o mayor a lo que detectamos
-            # en el paso anterior, significa que terminó.
-            if (p + f) >= expected_count:
-                return p, f, logs
-                
-            # Si no, esperamos un poco más
-            time.sleep(2)
+            avance, terminado, resultado, texto = consultar(i)
+        except CircuitoAbierto as e:
+            # El host viene fallando: seguir sondeando hasta el plazo solo alarga la corrida.
+            logs.append(f"   ⛔ {e}")
+            return False, resultado, logs
         except Exception as e:
-            logs.append(f"   ❌ Error Sync: {e}")
-            time.sleep(1)
-            
+            sumar(reintentos=1)
+            avance, terminado, texto = None, False, f"   ❌ Error: {e}"
+        ahora = time.monotonic()
+        logs.append(f"{texto} · {(ahora - t0) * 1000:.0f} ms · t+{ahora - inicio:.1f}s")
+        if terminado:
+            return True, resultado, logs
+
+        if avance is not None:
+            if avance > mejor:
+                mejor = avance
+                plazo = min(max(plazo, ahora - inicio + config["extension"]), config["plazo_max"])
+            sin_cambio = sin_cambio + 1 if avance == previo else 0
+            previo = avance
+            if sin_cambio_max and sin_cambio >= sin_cambio_max:
+                return False, resultado, logs
+
+        restante = plazo - (ahora - inicio)
+        if restante <= 0:
+            logs.append(f"   ⏱️ Plazo de {plazo:.0f}s agotado tras {i} consulta(s)")
+            return False, resultado, logs
+        time.sleep(min(espera * random.uniform(0.5, 1.0), restante))
+        espera = min(espera * config["factor"], config["espera_max"])
+
+
+def loop_sincronizar_robusto(session, url, expected_count):
+    """
+    Intenta sincronizar esperando a que el servidor confirme la cantidad esperada.
+    """
+    def consultar(i):
+        r = session.post(url, timeout=TIMEOUT_LLAMADA, idempotente=True)
+        d = r.json()
+        if isinstance(d, list) and d: d = d[0]
+        p = d.get("processed_record", 0)
+        f = d.get("failed_record", 0)
+        # Si la suma de procesados + fallidos es igual o mayor a lo que detectamos
+        # en el paso anterior, significa que terminó.
+        return p + f, (p + f) >= expected_count, (p, f), f"   🔹 [SINCR #{i}] Proc: {p} | Fail: {f}"
+
+    terminado, resultado, logs = sondeo_adaptativo(consultar, POLL_CONFIG["sincronizar"])
+    if terminado:
+        return resultado[0], resultado[1], logs
     # Si se acaba el tiempo, devolvemos lo que tengamos
     logs.append("   ⚠️ Timeout en Sincronización (No se confirmaron todos los registros)")
     return 0, 0, logs
 
 def loop_reconciliar(session, url, target_count, line_count):
-    logs = []
-    max_runs = get_reconcile_retries(line_count)
-    last_count, prev_count, no_change = 0, -1, 0
-    
-    for i in range(max_runs):
-        try:
-            r = session.post(url, json={})
-            try: d = r.json()
-            except: d = []
-            ids = d if isinstance(d, list) else d.get("data", d.get("steps", []))
-            last_count = len(ids)
-            
-            logs.append(f"   🔸 [RECONC #{i+1}] IDs: {last_count}")
-            
-            if last_count == target_count and target_count > 0: 
-                logs.append("   ✅ Target alcanzado.")
-                break
-            
-            if last_count == prev_count:
-                no_change += 1
-                if no_change >= 2: break
-            else: no_change = 0
-            prev_count = last_count
-            time.sleep(1)
-        except Exception as e:
-            logs.append(f"   ❌ Error Reconciliar: {str(e)}")
-            continue
-    return last_count, logs
+    def consultar(i):
+        r = session.post(url, json={}, timeout=TIMEOUT_LLAMADA, idempotente=True)
+        try: d = r.json()
+        except: d = []
+        ids = d if isinstance(d, list) else d.get("data", d.get("steps", []))
+        n = len(ids)
+        return n, n == target_count and target_count > 0, n, f"   🔸 [RECONC #{i}] IDs: {n}"
+
+    # Sin cambios en 2 consultas seguidas = el servidor ya no tiene más IDs que devolver.
+    terminado, last_count, logs = sondeo_adaptativo(consultar, POLL_CONFIG["reconciliar"], line_count, sin_cambio_max=2)
+    if terminado:
+        logs.append("   ✅ Target alcanzado.")
+    return last_count or 0, logs
+
+# --- SUBIDA EN STREAMING ---
+class CuerpoMultipart:
+    """
+    Cuerpo multipart/form-data que requests envía por bloques (con Content-Length) sin
+    armar el payload completo en memoria. Cuenta las líneas del archivo mientras lo envía.
+    """
+    def __init__(self, campos, nombre_campo, filename, archivo, tamano):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        cabecera = "".join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n' for k, v in campos.items()
+        ) + f'--{boundary}\r\nContent-Disposition: form-data; name="{nombre_campo}"; filename="{filename}"\r\n\r\n'
+        self._partes = [BytesIO(cabecera.encode("utf-8")), archivo, BytesIO(f"\r\n--{boundary}--\r\n".encode())]
+        self._largo = self._partes[0].getbuffer().nbytes + tamano + self._partes[2].getbuffer().nbytes
+        self.lineas = ContadorLineas()
+
+    def __len__(self):
+        return self._largo
+
+    def read(self, n=CHUNK_SIZE):
+        if n is None or n < 0:
+            n = CHUNK_SIZE
+        while self._partes:
+            parte = self._partes[0]
+            bloque = parte.read(n)
+            if bloque:
+                if len(self._partes) == 2:
+                    self.lineas.agregar(bloque)
+                return bloque
+            self._partes.pop(0)
+        return b""
+
+    def __iter__(self):
+        return iter(lambda: self.read(CHUNK_SIZE), b"")
+
+def subir_stream(session, url, archivo, tamano, filename, campos, nombre_campo="edt"):
+    cuerpo = CuerpoMultipart(campos, nombre_campo, filename, archivo, tamano)
+    r = session.post(url, data=cuerpo, headers={"Content-Type": cuerpo.content_type}, timeout=TIMEOUT_SUBIDA)
+    return r, cuerpo.lineas.total
 
 # --- FLUJO PRINCIPAL ---
-def api_upload_flow(file_bytes, filename, sub_id, flow_key, line_count):
+def nueva_sesion(pool_size=MAX_FLUJOS_SIMULTANEOS):
+    session = SesionResiliente()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def api_upload_flow(file_bytes, filename, sub_id, flow_key, line_count=None, session=None, on_log=None):
+    """
+    file_bytes puede ser bytes, una ruta o un objeto archivo binario: el archivo se sube en
+    streaming. Si line_count es None se toma del conteo hecho durante la subida.
+    """
+    with abrir_archivo(file_bytes) as (archivo, tamano), tramo("api_upload_flow", archivo=filename, flujo=flow_key) as t:
+        res = _api_upload_flow(archivo, tamano, filename, sub_id, flow_key, line_count, session, on_log)
+        t["status"] = res["status"]
+        return res
+
+def _api_upload_flow(archivo, tamano, filename, sub_id, flow_key, line_count, session, on_log):
     eps = ENDPOINTS[flow_key]
     execution_logs = []
+
+    def log(*mensajes):
+        execution_logs.extend(mensajes)
+        if on_log:
+            for m in mensajes: on_log(m)
     
-    if len(file_bytes) == 0:
-        return {"status": "❌ Error Bytes", "details": "0 bytes", "proc": 0, "rec": 0, "logs": ["❌ 0 bytes"]}
+    if tamano == 0:
+        log("❌ 0 bytes")
+        return {"status": "❌ Error Bytes", "details": "0 bytes", "proc": 0, "rec": 0, "logs": execution_logs}
     
-    session = requests.Session()
-    file_stream = BytesIO(file_bytes)
-    execution_logs.append(f"📦 Enviando {len(file_bytes)} bytes...")
+    session = session or SesionResiliente()
+    log(f"📦 Enviando {tamano} bytes...")
 
     # VARIABLES
     proc_detected = 0
@@ -154,41 +408,46 @@ def api_upload_flow(file_bytes, filename, sub_id, flow_key, line_count):
 
     try:
         # 1. SUBIR
-        files = {"edt": (filename, file_stream)}
-        data = {"subscription_public_id": sub_id}
-        session.post(eps["subir"], files=files, data=data).raise_for_status()
-        execution_logs.append("✅ [SUBIR] OK")
+        with tramo("edt.subir", archivo=filename, flujo=flow_key, requests=1, bytes=tamano) as t:
+            r1, lineas_subidas = subir_stream(session, eps["subir"], archivo, tamano, filename, {"subscription_public_id": sub_id})
+            r1.raise_for_status()
+        if line_count is None:
+            line_count = lineas_subidas
+        log(f"✅ [SUBIR] OK · {t['duracion_ms']:.0f} ms")
         
         # 2. PROCESAR
-        r2 = session.post(eps["procesar"])
-        r2.raise_for_status()
+        with tramo("edt.procesar", archivo=filename, flujo=flow_key, requests=1) as t:
+            r2 = session.post(eps["procesar"], timeout=TIMEOUT_LLAMADA)
+            r2.raise_for_status()
+            t["bytes"] = len(r2.content)
         
         try: 
             json_proc = r2.json()
             proc_detected, fail_detected = extraer_conteo_procesar(json_proc)
-            execution_logs.append(f"✅ [PROCESAR] OK. Detectados: {proc_detected} | Fallidos: {fail_detected}")
+            log(f"✅ [PROCESAR] OK. Detectados: {proc_detected} | Fallidos: {fail_detected} · {t['duracion_ms']:.0f} ms")
         except:
-            execution_logs.append("✅ [PROCESAR] OK (JSON ilegible)")
+            log(f"✅ [PROCESAR] OK (JSON ilegible) · {t['duracion_ms']:.0f} ms")
         
     except Exception as e:
-        execution_logs.append(f"❌ ERROR API: {str(e)}")
+        log(f"❌ ERROR API: {str(e)}")
         return {"status": "❌ Error API", "details": str(e), "proc": 0, "rec": 0, "logs": execution_logs}
 
     # --- DECISIÓN ---
     if proc_detected == 0 and fail_detected == 0:
-        execution_logs.append("🛑 Sin datos detectados en Parse. Terminando.")
-        try: session.post(eps["reconciliar"], json={}) 
+        log("🛑 Sin datos detectados en Parse. Terminando.")
+        try: session.post(eps["reconciliar"], json={}, timeout=TIMEOUT_LLAMADA) 
         except: pass
         return {"status": "ℹ️ Sin Datos", "details": "0 registros", "proc": 0, "rec": 0, "logs": execution_logs}
 
     # 3. SINCRONIZAR (USANDO EL BUCLE ROBUSTO NUEVO)
-    execution_logs.append(f"🔄 [SINCRONIZAR] Esperando confirmación de {proc_detected} registros...")
+    log(f"🔄 [SINCRONIZAR] Esperando confirmación de {proc_detected} registros...")
     
     # Esperamos que la suma de (proc + fail) llegue al menos a lo que detectamos
     target_sync = proc_detected + fail_detected
     
-    final_proc, final_fail, sync_logs = loop_sincronizar_robusto(session, eps["sincronizar"], target_sync)
-    execution_logs.extend(sync_logs)
+    with tramo("edt.sincronizar", archivo=filename, flujo=flow_key) as t:
+        final_proc, final_fail, sync_logs = loop_sincronizar_robusto(session, eps["sincronizar"], target_sync)
+    log(*sync_logs, f"   ⏱️ Sincronización: {t['requests']} consulta(s) · {t['duracion_ms'] / 1000:.1f}s")
 
     # 4. RECONCILIAR
     # Usamos los fallos detectados como target
@@ -199,8 +458,9 @@ def api_upload_flow(file_bytes, filename, sub_id, flow_key, line_count):
     if final_fail > 0: status = "⚠️ Con Fallos"
     if final_proc == 0 and final_fail == 0: status = "⚠️ Error Sincronización"
 
-    recon_total, recon_logs = loop_reconciliar(session, eps["reconciliar"], target_rec, line_count)
-    execution_logs.extend(recon_logs)
+    with tramo("edt.reconciliar", archivo=filename, flujo=flow_key) as t:
+        recon_total, recon_logs = loop_reconciliar(session, eps["reconciliar"], target_rec, line_count)
+    log(*recon_logs, f"   ⏱️ Reconciliación: {t['requests']} consulta(s) · {t['duracion_ms'] / 1000:.1f}s")
 
     return {
         "status": status, 
@@ -209,3 +469,93 @@ def api_upload_flow(file_bytes, filename, sub_id, flow_key, line_count):
         "rec": recon_total, 
         "logs": execution_logs
     }
+
+# --- ORQUESTADOR ---
+CANCELADO = "⏹️ Cancelado"
+
+
+class FlujoCancelado(Exception):
+    pass
+
+
+def _resultado_omitido(status, details):
+    return {"status": status, "details": details, "proc": 0, "rec": 0, "logs": [f"{status}: {details}"]}
+
+def orquestar_cargas(archivos, max_flujos=MAX_FLUJOS_SIMULTANEOS, cancelado=None):
+    """
+    Ejecuta api_upload_flow para muchos archivos a la vez.
+    archivos: iterable de (filename, archivo, flow_key); archivo como en api_upload_flow
+    (bytes, ruta u objeto archivo). Cada archivo se enruta con
+    find_subscription_id según REGLAS_POR_FLUJO[flow_key] y se valida con validar_contenido.
+    Genera eventos a medida que avanzan los flujos:
+      {"indice", "archivo", "flujo", "sub_id", "tipo": "log", "mensaje": str}
+      {"indice", "archivo", "flujo", "sub_id", "tipo": "fin", "resultado": dict}  (uno por archivo)
+    indice es la posición del archivo en ``archivos``: los nombres pueden repetirse.
+    cancelado: función opcional; si devuelve True, los flujos que aún no empezaron
+    terminan con status CANCELADO sin llamar a la API (los ya iniciados siguen).
+    """
+    eventos = queue.Queue()
+    # Archivos de una misma (flujo, suscripción) van en serie: solo el primero de cada FIFO
+    # está en el pool y el siguiente se envía cuando termina, sin ocupar hilos esperando.
+    colas = {}
+    sesiones = {flow_key: nueva_sesion(max_flujos) for flow_key in ENDPOINTS}
+
+    def ejecutar(indice, filename, file_bytes, flow_key, sub_id, line_count):
+        base = {"indice": indice, "archivo": filename, "flujo": flow_key, "sub_id": sub_id}
+        try:
+            if cancelado and cancelado():
+                raise FlujoCancelado()
+            eventos.put({**base, "tipo": "log", "mensaje": "▶️ Iniciando flujo"})
+            res = api_upload_flow(file_bytes, filename, sub_id, flow_key, line_count, session=sesiones[flow_key],
+                                  on_log=lambda m: eventos.put({**base, "tipo": "log", "mensaje": m}))
+        except FlujoCancelado:
+            res = _resultado_omitido(CANCELADO, "Cancelado antes de iniciar")
+        except Exception as e:
+            res = _resultado_omitido("❌ Error API", str(e))
+        eventos.put({**base, "tipo": "fin", "resultado": res})
+
+    pendientes = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_flujos) as pool:
+            def enviar(clave):
+                # Copia del contexto: los tramos del flujo van al registro activo de quien orquesta.
+                pool.submit(contextvars.copy_context().run, ejecutar, *colas[clave][0])
+
+            def terminar(evento):
+                # Al terminar un flujo se envía el siguiente archivo de su misma suscripción.
+                clave = (evento["flujo"], evento["sub_id"])
+                colas[clave].popleft()
+                if colas[clave]:
+                    enviar(clave)
+
+            for indice, (filename, file_bytes, flow_key) in enumerate(archivos):
+                sub_id = ENRUTADORES[flow_key](filename)
+                base = {"indice": indice, "archivo": filename, "flujo": flow_key, "sub_id": sub_id}
+                if not sub_id:
+                    yield {**base, "tipo": "fin", "resultado": _resultado_omitido("❌ Sin Suscripción", "Ninguna regla coincide con el nombre")}
+                    continue
+                ok, motivo, line_count = validar_contenido(filename, Path(file_bytes) if isinstance(file_bytes, str) else file_bytes)
+                if not ok:
+                    yield {**base, "tipo": "fin", "resultado": _resultado_omitido("⚠️ Omitido", motivo)}
+                    continue
+                cola = colas.setdefault((flow_key, sub_id), deque())
+                cola.append((indice, filename, file_bytes, flow_key, sub_id, line_count))
+                if len(cola) == 1:
+                    enviar((flow_key, sub_id))
+                pendientes += 1
+                # Mientras se enrutan los demás, se atiende lo que ya terminó.
+                while not eventos.empty():
+                    evento = eventos.get()
+                    if evento["tipo"] == "fin":
+                        pendientes -= 1
+                        terminar(evento)
+                    yield evento
+            while pendientes:
+                evento = eventos.get()
+                if evento["tipo"] == "fin":
+                    pendientes -= 1
+                    terminar(evento)
+                yield evento
+    finally:
+        for session in sesiones.values():
+            session.close()
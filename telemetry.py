@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Tramos de tiempo livianos para saber en qué etapa se va una corrida.
+
+    with tramo("consultar_api_tins", tins=len(tins)) as t:
+        ...
+        t["requests"] += n
+
+Cada tramo guarda etapa, inicio, duración en ms y los contadores ``requests``,
+``reintentos`` y ``bytes``, más los atributos que se pasen. Se acumulan en el
+registro activo del contexto (``usar_registro``; la UI usa uno por sesión) o en
+``REGISTRO_GLOBAL``. Solo usa la biblioteca estándar.
+"""
+import contextvars
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+MAX_TRAMOS = 5000
+CONTADORES = ("requests", "reintentos", "bytes")
+
+
+class RegistroTramos:
+    """Tramos terminados (los últimos ``max_tramos``), seguro entre hilos."""
+
+    def __init__(self, max_tramos=MAX_TRAMOS):
+        self._tramos = deque(maxlen=max_tramos)
+        self._lock = threading.Lock()
+
+    def agregar(self, tramo):
+        with self._lock:
+            self._tramos.append(tramo)
+
+    def extender(self, tramos):
+        with self._lock:
+            self._tramos.extend(tramos)
+
+    def tramos(self):
+        with self._lock:
+            return list(self._tramos)
+
+    def limpiar(self):
+        with self._lock:
+            self._tramos.clear()
+
+    def resumen(self):
+        """Una fila por etapa, en orden de aparición: n, total/máx ms y contadores sumados."""
+        filas = {}
+        for t in self.tramos():
+            f = filas.setdefault(t["etapa"], {"etapa": t["etapa"], "n": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                              **dict.fromkeys(CONTADORES, 0), "errores": 0})
+            f["n"] += 1
+            f["total_ms"] = round(f["total_ms"] + t["duracion_ms"], 1)
+            f["max_ms"] = max(f["max_ms"], t["duracion_ms"])
+            for c in CONTADORES:
+                f[c] += t.get(c, 0)
+            f["errores"] += 1 if t.get("error") else 0
+        return list(filas.values())
+
+    def a_jsonl(self):
+        return tramos_jsonl(self.tramos())
+
+
+def tramos_jsonl(tramos):
+    return "".join(json.dumps(t, ensure_ascii=False, default=str) + "\n" for t in tramos)
+
+
+REGISTRO_GLOBAL = RegistroTramos()
+_registro_activo = contextvars.ContextVar("registro_tramos", default=None)
+_tramo_actual = contextvars.ContextVar("tramo_actual", default=None)
+_lock_contadores = threading.Lock()
+
+
+def registro_actual():
+    return _registro_activo.get() or REGISTRO_GLOBAL
+
+
+def activar_registro(registro):
+    """Fija el registro activo para el resto del contexto actual (p.ej. una ejecución del script de Streamlit)."""
+    _registro_activo.set(registro)
+
+
+@contextmanager
+def usar_registro(registro):
+    token = _registro_activo.set(registro)
+    try:
+        yield registro
+    finally:
+        _registro_activo.reset(token)
+
+
+@contextmanager
+def tramo(etapa, **atributos):
+    """Mide el bloque y lo agrega al registro activo al salir (también si falla)."""
+    t = {"etapa": etapa, "inicio": round(time.time(), 3), **dict.fromkeys(CONTADORES, 0), **atributos}
+    registro = registro_actual()
+    token = _tramo_actual.set(t)
+    t0 = time.perf_counter()
+    try:
+        yield t
+    except BaseException as e:
+        t["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        t["duracion_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        _tramo_actual.reset(token)
+        registro.agregar(t)
+
+
+def sumar(**contadores):
+    """Suma contadores al tramo abierto en este contexto (no hace nada si no hay ninguno)."""
+    t = _tramo_actual.get()
+    if t is None:
+        return
+    with _lock_contadores:
+        for clave, valor in contadores.items():
+            t[clave] = t.get(clave, 0) + valor